@@ -0,0 +1,288 @@
+"""
+Measures Provider.get_response throughput and full consume round trips
+through the Flask, Django, WSGI, Twisted and ASGI adapters, in process, for
+several payload sizes.
+
+Usage: python benchmarks/adapters.py [--duration SECONDS] [--output FILE]
+                                     [--compare FILE] [--only NAME ...]
+
+--output writes the results as JSON, --compare prints the change relative
+to the results in an earlier output file.
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import webservices
+from webservices.models import PUBLIC_KEY_HEADER, Provider
+from webservices.serializers import get_serializer
+
+
+PAYLOADS = {
+    'small': 1,
+    'medium': 100,
+    'large': 10000,
+}
+
+
+def make_payload(items):
+    return {
+        'items': [
+            {'id': i, 'name': 'item %s' % i, 'price': i * 1.5, 'tags': ['a']}
+            for i in range(items)
+        ],
+    }
+
+
+class EchoProvider(Provider):
+    def get_private_key(self, public_key):
+        return 'privatekey'
+
+    def provide(self, data):
+        return data
+
+
+def measure(function, duration):
+    calls = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < duration:
+        function()
+        calls += 1
+        elapsed = time.time() - start
+    return calls, elapsed
+
+
+def bench_get_response(payload, duration):
+    provider = EchoProvider()
+    signed_data = get_serializer('json', 'privatekey').dumps(payload)
+    headers = {PUBLIC_KEY_HEADER: 'publickey'}
+    return measure(
+        lambda: provider.get_response('POST', signed_data, headers.get),
+        duration,
+    )
+
+
+def bench_flask(payload, duration):
+    from flask import Flask
+    from webservices.sync import FlaskTestingConsumer, provider_for_flask
+    app = Flask(__name__)
+    provider_for_flask(app, '/', EchoProvider())
+    consumer = FlaskTestingConsumer(
+        app.test_client(), 'http://localhost', 'publickey', 'privatekey')
+    return measure(lambda: consumer.consume('/', payload), duration)
+
+
+def bench_wsgi(payload, duration):
+    from werkzeug.test import Client
+    from webservices.sync import FlaskTestingConsumer
+    from webservices.wsgi import provider_for_wsgi
+    consumer = FlaskTestingConsumer(
+        Client(provider_for_wsgi(EchoProvider())),
+        'http://localhost',
+        'publickey',
+        'privatekey',
+    )
+    return measure(lambda: consumer.consume('/', payload), duration)
+
+
+def bench_django(payload, duration):
+    from django.test.client import Client
+    from webservices.sync import DjangoTestingConsumer
+    consumer = DjangoTestingConsumer(
+        Client(), 'http://localhost', 'publickey', 'privatekey')
+    return measure(lambda: consumer.consume('/', payload), duration)
+
+
+def bench_asgi(payload, duration):
+    import asyncio
+    from webservices.aio import ASGITestingConsumer, provider_for_asgi
+    consumer = ASGITestingConsumer(
+        provider_for_asgi(EchoProvider()),
+        'http://localhost',
+        'publickey',
+        'privatekey',
+    )
+    loop = asyncio.new_event_loop()
+    try:
+        return measure(
+            lambda: loop.run_until_complete(consumer.consume('/', payload)),
+            duration,
+        )
+    finally:
+        loop.close()
+
+
+def bench_twisted(payloads, duration):
+    # The reactor can only run once, so all payloads are measured in one go.
+    from twisted.internet import defer, reactor
+    from twisted.web.server import Site
+    # async is a keyword on Python 3.7+
+    twisted_adapter = importlib.import_module('webservices.async')
+    port = reactor.listenTCP(
+        0,
+        Site(twisted_adapter.provider_for_twisted(EchoProvider())),
+        interface='127.0.0.1',
+    )
+    consumer = twisted_adapter.TwistedConsumer(
+        'http://127.0.0.1:%s/' % port.getHost().port,
+        'publickey',
+        'privatekey',
+    )
+    results = {}
+
+    @defer.inlineCallbacks
+    def run():
+        try:
+            for name, payload in payloads:
+                calls = 0
+                start = time.time()
+                elapsed = 0
+                while elapsed < duration:
+                    yield consumer.consume('/', payload)
+                    calls += 1
+                    elapsed = time.time() - start
+                results[name] = (calls, elapsed)
+            yield consumer.close()
+            yield port.stopListening()
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+    return results
+
+
+urlpatterns = []
+
+
+def setup_django():
+    from django.conf import settings
+    try:
+        from django.urls import re_path
+    except ImportError:  # pragma: no cover
+        from django.conf.urls import url as re_path
+    from webservices.sync import provider_for_django
+    urlpatterns.append(re_path(r'^$', provider_for_django(EchoProvider())))
+    settings.configure(
+        DEBUG=False,
+        ROOT_URLCONF=__name__,
+        ALLOWED_HOSTS=['*'],
+        DATABASES={},
+        MIDDLEWARE=[],
+    )
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+
+
+BENCHMARKS = [
+    ('get_response', bench_get_response),
+    ('flask', bench_flask),
+    ('wsgi', bench_wsgi),
+    ('django', bench_django),
+    ('asgi', bench_asgi),
+]
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result(benchmark, payload, size, calls, elapsed):
+    return {
+        'benchmark': benchmark,
+        'payload': payload,
+        'bytes': size,
+        'calls': calls,
+        'seconds': elapsed,
+        'calls_per_second': calls / elapsed,
+        'mean_latency_ms': elapsed / calls * 1000,
+    }
+
+
+def report(results, baseline=None):
+    previous = {}
+    for entry in (baseline or {}).get('results', []):
+        previous[entry['benchmark'], entry['payload']] = entry
+    print('%-14s %-8s %10s %12s %12s %8s' % (
+        'benchmark', 'payload', 'bytes', 'calls/s', 'latency ms', 'change'))
+    for entry in results:
+        old = previous.get((entry['benchmark'], entry['payload']))
+        change = ''
+        if old is not None:
+            change = '%+.1f%%' % (
+                (entry['calls_per_second'] / old['calls_per_second'] - 1) *
+                100)
+        print('%-14s %-8s %10d %12.1f %12.3f %8s' % (
+            entry['benchmark'], entry['payload'], entry['bytes'],
+            entry['calls_per_second'], entry['mean_latency_ms'], change))
+
+
+def main():
+    names = [name for name, _ in BENCHMARKS] + ['twisted']
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=1.0)
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--only', nargs='+', choices=names, default=names)
+    args = parser.parse_args()
+
+    payloads = [
+        (name, make_payload(items))
+        for name, items in sorted(PAYLOADS.items(), key=lambda item: item[1])
+    ]
+    sizes = dict(
+        (name, len(get_serializer('json', 'privatekey').dumps(payload)))
+        for name, payload in payloads
+    )
+    if 'django' in args.only:
+        setup_django()
+
+    results = []
+    for benchmark, function in BENCHMARKS:
+        if benchmark not in args.only:
+            continue
+        for name, payload in payloads:
+            calls, elapsed = function(payload, args.duration)
+            results.append(
+                result(benchmark, name, sizes[name], calls, elapsed))
+    if 'twisted' in args.only:
+        for name, (calls, elapsed) in sorted(
+                bench_twisted(payloads, args.duration).items(),
+                key=lambda item: sizes[item[0]]):
+            results.append(
+                result('twisted', name, sizes[name], calls, elapsed))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fobj:
+            baseline = json.load(fobj)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as fobj:
+            json.dump({
+                'version': webservices.__version__,
+                'commit': get_commit(),
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'duration': args.duration,
+                'results': results,
+            }, fobj, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
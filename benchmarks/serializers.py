@@ -0,0 +1,68 @@
+"""
+Compares the throughput of the available serializers for a full round trip
+(sign and verify a request, then sign and verify the response).
+
+Usage: python benchmarks/serializers.py [--duration SECONDS]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webservices.serializers import available_serializers, get_serializer
+
+
+PAYLOADS = {
+    'small': {'name': 'webservices'},
+    'medium': {
+        'items': [
+            {'id': i, 'name': 'item %s' % i, 'price': i * 1.5, 'tags': ['a']}
+            for i in range(100)
+        ],
+    },
+    'large': {
+        'items': [
+            {'id': i, 'name': 'item %s' % i, 'price': i * 1.5, 'tags': ['a']}
+            for i in range(10000)
+        ],
+    },
+}
+
+
+def round_trip(consumer, provider, data):
+    request = provider.loads(consumer.dumps(data))
+    return consumer.loads(provider.dumps(request))
+
+
+def measure(serializer, data, duration):
+    consumer = get_serializer(serializer, 'privatekey')
+    provider = get_serializer(serializer, 'privatekey')
+    size = len(consumer.dumps(data))
+    calls = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < duration:
+        round_trip(consumer, provider, data)
+        calls += 1
+        elapsed = time.time() - start
+    return calls / elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=1.0)
+    args = parser.parse_args()
+    print('%-8s %-8s %14s %10s %10s' % (
+        'payload', 'format', 'round trips/s', 'bytes', 'vs json'))
+    for name, data in sorted(PAYLOADS.items()):
+        baseline, _ = measure('json', data, args.duration)
+        for serializer in available_serializers():
+            rate, size = measure(serializer, data, args.duration)
+            print('%-8s %-8s %14.1f %10d %9.2fx' % (
+                name, serializer, rate, size, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,12 +10,17 @@ setup(
     platforms=['OS Independent'],
     install_requires=[
         'itsdangerous',
+        'futures; python_version < "3"',
     ],
     extras_require={
         'django':  ["django", "requests"],
         'flask': ["flask", "requests"],
         'twisted': ["twisted"],
         'consumer': ["requests"],
+        'orjson': ["orjson"],
+        'msgpack': ["msgpack"],
+        'zstd': ["zstandard"],
+        'brotli': ["brotli"],
     },
     tests_require=[
         'twisted',
@@ -0,0 +1,777 @@
+import asyncio
+import functools
+import inspect
+import ssl
+import time
+from collections.abc import AsyncIterator, Iterator
+from urllib.parse import urlsplit, urlunsplit
+
+from webservices.deadline import (
+    copy_context,
+    expired,
+    get_deadline,
+    reset_deadline,
+    set_deadline,
+)
+from webservices.exceptions import DeadlineExceeded, RequestRejected
+from webservices.metrics import NULL_TIMER
+from webservices.cache import MISSING
+from webservices.models import (
+    BATCH_HEADER,
+    SERIALIZER_HEADER,
+    STREAM_HEADER,
+    BaseConsumer,
+    Response,
+    batch_error,
+    batch_result,
+    response_body,
+    unix_socket_path,
+)
+from webservices.serializers import (
+    DEFAULT_SERIALIZER,
+    SERIALIZERS,
+    get_content_type,
+)
+from webservices.streaming import STREAM_CONTENT_TYPE, FrameWriter
+from webservices.wsgi import DEFAULT_MAX_BODY_SIZE
+
+
+DEFAULT_PORTS = {
+    'http': 80,
+    'https': 443,
+}
+
+
+class HTTPConnection(object):
+    """
+    Minimal HTTP/1.1 client connection on top of asyncio streams.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reusable = False
+        self.response_started = False
+        self.version = None
+
+    def is_closed(self):
+        return self.writer.is_closing() or self.reader.at_eof()
+
+    def close(self):
+        self.reusable = False
+        self.writer.close()
+
+    async def start(self, method, target, headers, body):
+        """
+        Sends the request and returns the status code and headers of the
+        response, its body must then be read using ``iter_body``.
+        """
+        self.reusable = False
+        self.response_started = False
+        lines = ['%s %s HTTP/1.1' % (method, target)]
+        lines.extend('%s: %s' % item for item in headers.items())
+        head = '\r\n'.join(lines) + '\r\n\r\n'
+        self.writer.write(head.encode('latin-1') + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by server')
+        self.response_started = True
+        self.version, status_code = status_line.decode(
+            'latin-1').split(None, 2)[:2]
+        response_headers = await self._read_headers()
+        return int(status_code), response_headers
+
+    async def iter_body(self, response_headers):
+        """
+        Yields the response body as it arrives.
+        """
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            async for chunk in self._iter_chunked():
+                yield chunk
+        elif 'content-length' in response_headers:
+            yield await self.reader.readexactly(
+                int(response_headers['content-length']))
+        else:
+            while True:
+                chunk = await self.reader.read(65536)
+                if not chunk:
+                    return
+                yield chunk
+
+        connection = response_headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            self.reusable = connection == 'keep-alive'
+        else:
+            self.reusable = connection != 'close'
+
+    async def _read_headers(self):
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return headers
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+    async def _iter_chunked(self):
+        while True:
+            size_line = await self.reader.readline()
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if not size:
+                await self._read_headers()
+                return
+            yield await self.reader.readexactly(size)
+            await self.reader.readexactly(2)
+
+
+class ConnectionPool(object):
+    """
+    Pool of keep-alive connections, shared by all hosts it talks to.
+
+    ``max_connections`` caps the number of concurrent requests (and thus
+    open connections) going through the pool.
+    """
+    def __init__(self, max_connections=10, ssl_context=None):
+        self.max_connections = max_connections
+        self.ssl_context = ssl_context
+        self._idle = {}
+        self._semaphore = None
+
+    async def request(self, method, url, headers, body, timeout=None):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        async with self._semaphore:
+            if timeout is None:
+                return await self._request(method, url, headers, body)
+            return await asyncio.wait_for(
+                self._request(method, url, headers, body), timeout)
+
+    async def stream(self, method, url, headers, body, timeout=None):
+        """
+        Like ``request``, but yields the status code and headers of the
+        response first and then its body as it arrives. ``timeout`` only
+        applies to receiving the headers.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        async with self._semaphore:
+            start = self._start(method, url, headers, body)
+            if timeout is not None:
+                start = asyncio.wait_for(start, timeout)
+            key, connection, status_code, response_headers = await start
+            try:
+                yield status_code, response_headers
+                async for chunk in connection.iter_body(response_headers):
+                    yield chunk
+            except BaseException:
+                connection.close()
+                raise
+            self._release(key, connection)
+
+    async def _request(self, method, url, headers, body):
+        key, connection, status_code, response_headers = await self._start(
+            method, url, headers, body)
+        chunks = []
+        try:
+            async for chunk in connection.iter_body(response_headers):
+                chunks.append(chunk)
+        except BaseException:
+            connection.close()
+            raise
+        self._release(key, connection)
+        return status_code, response_headers, b''.join(chunks)
+
+    async def _start(self, method, url, headers, body):
+        parts = urlsplit(url)
+        socket_path = unix_socket_path(url)
+        if socket_path is not None:
+            key = (parts.scheme, socket_path, None)
+        else:
+            key = (
+                parts.scheme,
+                parts.hostname,
+                parts.port or DEFAULT_PORTS[parts.scheme],
+            )
+        target = urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        headers = dict(headers)
+        headers['Host'] = parts.netloc
+        headers['Content-Length'] = str(len(body))
+        while True:
+            connection, reused = await self._acquire(key)
+            try:
+                status_code, response_headers = await connection.start(
+                    method, target, headers, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                connection.close()
+                # Idle connections may have been closed by the server in
+                # the meantime, retry those on a fresh connection.
+                if reused and not connection.response_started:
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            return key, connection, status_code, response_headers
+
+    async def _acquire(self, key):
+        idle = self._idle.get(key, [])
+        while idle:
+            connection = idle.pop()
+            if not connection.is_closed():
+                return connection, True
+            connection.close()
+        scheme, host, port = key
+        if port is None:
+            # http+unix, the host is the path of the socket.
+            reader, writer = await asyncio.open_unix_connection(host)
+            return HTTPConnection(reader, writer), False
+        ssl_context = None
+        if scheme == 'https':
+            ssl_context = self.ssl_context or ssl.create_default_context()
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=ssl_context)
+        return HTTPConnection(reader, writer), False
+
+    def _release(self, key, connection):
+        idle = self._idle.setdefault(key, [])
+        if connection.reusable and len(idle) < self.max_connections:
+            idle.append(connection)
+        else:
+            connection.close()
+
+    def close(self):
+        for idle in self._idle.values():
+            for connection in idle:
+                connection.close()
+        self._idle.clear()
+
+
+class AsyncioConsumer(BaseConsumer):
+    def __init__(self, base_url, public_key, private_key, pool=None,
+                 max_connections=10, timeout=None, **kwargs):
+        super(AsyncioConsumer, self).__init__(
+            base_url, public_key, private_key, **kwargs)
+        if pool is None:
+            pool = ConnectionPool(max_connections)
+        self.pool = pool
+        self.timeout = timeout
+
+    async def consume(self, path, data, max_age=None):
+        return await super(AsyncioConsumer, self).consume(
+            path, data, max_age)
+
+    async def consume_many(self, path, items, max_age=None):
+        return await super(AsyncioConsumer, self).consume_many(
+            path, items, max_age)
+
+    async def send_request(self, url, data, headers):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        status_code, response_headers, body = await self.pool.request(
+            'POST', url, headers, data, timeout=self.timeout)
+        self.raise_for_status(status_code, body)
+        return Response(body, response_headers)
+
+    async def handle_response(self, response, max_age):
+        response = await response
+        return self.signer.loads(response_body(response), max_age=max_age)
+
+    def add_callback(self, result, callback):
+        async def chain():
+            return callback(await result)
+        return chain()
+
+    def as_result(self, value):
+        async def result():
+            return value
+        return result()
+
+    async def consume_stream(self, path, data, max_age=None):
+        """
+        Yields the items streamed by the provider as they arrive, each of
+        them verified on its own::
+
+            async for item in consumer.consume_stream('/export/', query):
+                ...
+        """
+        if not path.startswith('/'):
+            raise ValueError("Paths must start with a slash")
+        chunks = self.open_stream(
+            self.build_url(path),
+            self.signer.dumps(data),
+            self.build_headers({STREAM_HEADER: '1'}),
+        )
+        reader = self.get_frame_reader(max_age)
+        try:
+            async for chunk in chunks:
+                for item in reader.feed(chunk):
+                    yield item
+        finally:
+            await chunks.aclose()
+        reader.close()
+
+    async def open_stream(self, url, data, headers):
+        """
+        Sends the request and yields the response body as it arrives.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        response = self.pool.stream(
+            'POST', url, headers, data, timeout=self.timeout)
+        try:
+            status_code, response_headers = await response.__anext__()
+            if status_code != 200:
+                body = b''.join([chunk async for chunk in response])
+                self.raise_for_status(status_code, body)
+            async for chunk in response:
+                yield chunk
+        finally:
+            await response.aclose()
+
+    def make_call_group(self):
+        return FutureGroup()
+
+    def close(self):
+        self.pool.close()
+
+
+class ASGITestingConsumer(AsyncioConsumer):
+    def __init__(self, app, base_url, public_key, private_key, **kwargs):
+        self.app = app
+        super(ASGITestingConsumer, self).__init__(
+            base_url, public_key, private_key, **kwargs)
+
+    def build_url(self, path):
+        return path
+
+    async def send_request(self, url, data, headers):
+        status_code, response_headers, messages = await self.call_app(
+            url, data, headers)
+        body = b''.join(message.get('body', b'') for message in messages)
+        self.raise_for_status(status_code, body)
+        return Response(body, response_headers)
+
+    async def open_stream(self, url, data, headers):
+        status_code, response_headers, messages = await self.call_app(
+            url, data, headers)
+        if status_code != 200:
+            self.raise_for_status(status_code, b''.join(
+                message.get('body', b'') for message in messages))
+        for message in messages:
+            yield message.get('body', b'')
+
+    async def call_app(self, url, data, headers):
+        """
+        Returns the status code, headers and body messages of the response.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': data, 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'POST',
+            'scheme': 'http',
+            'path': url,
+            'raw_path': url.encode('latin-1'),
+            'query_string': b'',
+            'root_path': '',
+            'headers': [
+                (key.lower().encode('latin-1'), value.encode('latin-1'))
+                for key, value in headers.items()
+            ],
+        }
+        await self.app(scope, receive, send)
+        status_code = messages[0]['status']
+        response_headers = dict(
+            (key.decode('latin-1'), value.decode('latin-1'))
+            for key, value in messages[0]['headers']
+        )
+        return status_code, response_headers, messages[1:]
+
+
+async def provide(provider, data, executor=None):
+    if provider.processes:
+        # Waits for the worker process in a thread.
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            executor, provider.process_pool.submit(data))
+    if executor is not None and not inspect.iscoroutinefunction(
+            provider.provide):
+        loop = asyncio.get_event_loop()
+        # Executors do not copy the context, which holds the deadline.
+        return await loop.run_in_executor(executor, functools.partial(
+            copy_context(), provider.provide, data))
+    result = provider.provide(data)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+async def _as_value(response_data):
+    # Streams requested without STREAM_HEADER are sent as a whole.
+    if isinstance(response_data, AsyncIterator):
+        return [item async for item in response_data]
+    if isinstance(response_data, Iterator):
+        return list(response_data)
+    return response_data
+
+
+class AsyncResponseStream(object):
+    """
+    Asynchronous version of ``webservices.streaming.ResponseStream``.
+    """
+    content_type = STREAM_CONTENT_TYPE
+
+    def __init__(self, frames):
+        self.frames = frames
+
+    def __aiter__(self):
+        return self.frames
+
+    async def aclose(self):
+        await self.frames.aclose()
+
+
+async def _next_item(results, executor):
+    if isinstance(results, AsyncIterator):
+        try:
+            return await results.__anext__()
+        except StopAsyncIteration:
+            return MISSING
+    if executor is None:
+        return next(results, MISSING)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, functools.partial(
+        copy_context(), next, results, MISSING))
+
+
+async def stream_response(provider, signer, results, executor=None,
+                          timer=NULL_TIMER):
+    """
+    Asynchronous version of ``Provider.stream_response``. ``results`` may
+    also be an asynchronous iterator, synchronous ones are advanced in
+    ``executor`` if one is given.
+    """
+    if not isinstance(results, (AsyncIterator, Iterator)):
+        results = iter([results])
+    first = await _next_item(results, executor)
+    return AsyncResponseStream(_stream_frames(
+        provider, signer, first, results, executor, get_deadline(), timer))
+
+
+async def _stream_frames(provider, signer, item, results, executor, deadline,
+                         timer):
+    writer = FrameWriter(signer)
+    try:
+        while item is not MISSING:
+            yield writer.item(item)
+            if deadline is not None and deadline <= time.time():
+                yield writer.error("Deadline exceeded", 504)
+                return
+            failed = False
+            token = set_deadline(deadline)
+            try:
+                item = await _next_item(results, executor)
+            except Exception:
+                provider.report_exception()
+                failed = True
+            finally:
+                reset_deadline(token)
+            if failed:
+                yield writer.error("Failed to process the request")
+                return
+        timer.mark('provide')
+        yield writer.end()
+    finally:
+        if isinstance(results, AsyncIterator):
+            if hasattr(results, 'aclose'):
+                await results.aclose()
+        elif hasattr(results, 'close'):
+            results.close()
+
+
+async def _provide_item(provider, item, executor):
+    if expired():
+        return batch_error("Deadline exceeded", 504)
+    try:
+        return batch_result(
+            await _as_value(await provide(provider, item, executor)))
+    except DeadlineExceeded:
+        return batch_error("Deadline exceeded", 504)
+    except Exception:
+        provider.report_exception()
+        return batch_error("Failed to process the request")
+
+
+class FutureGroup(object):
+    """
+    asyncio counterpart of ``webservices.singleflight.Group``: concurrent
+    calls to ``do`` with the same key share a single future.
+    """
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+
+    def do(self, key, function):
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(function())
+            self._calls[key] = future
+            future.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.shared += 1
+        return asyncio.shield(future)
+
+
+async def get_idempotent_response(provider, key, compute, set_header=None):
+    """
+    Asynchronous version of ``Provider.get_idempotent_response``,
+    ``compute`` must be a coroutine function.
+    """
+    async def compute_entry():
+        headers = {}
+        status_code, response_data = await compute(headers.__setitem__)
+        entry = (status_code, response_data, headers)
+        if status_code == 200:
+            provider.idempotency_cache.set(key, entry)
+        return entry
+
+    entry = provider.idempotency_cache.get(key)
+    if entry is None:
+        calls = provider.__dict__.setdefault(
+            '_async_idempotency_calls', FutureGroup())
+        entry = await calls.do(key, compute_entry)
+    status_code, response_data, headers = entry
+    if set_header is not None:
+        for header, value in headers.items():
+            set_header(header, value)
+    return status_code, response_data
+
+
+async def get_response(provider, method, signed_data, get_header,
+                       set_header=None, executor=None, path=None):
+    """
+    Asynchronous version of ``Provider.get_response``. ``provide`` may be a
+    coroutine function, synchronous ``provide`` methods are run in
+    ``executor`` if one is given.
+    """
+    timer = provider.get_timer(get_header)
+    deadline = provider.get_deadline(get_header)
+    try:
+        provider.check_deadline(deadline)
+        target = provider.get_provider(path)
+        if target is None:
+            raise RequestRejected(404, "Not found")
+        signer, data = provider.load_request(
+            method, signed_data, get_header, timer)
+        provider.check_deadline(deadline)
+    except RequestRejected as rejected:
+        timer.done(rejected.response[0])
+        return rejected.response
+
+    async def compute(set_header):
+        return await process_request(
+            target, signer, data, get_header, set_header, executor, timer)
+
+    token = set_deadline(deadline)
+    try:
+        if provider.idempotency_window and not get_header(STREAM_HEADER, None):
+            response = await get_idempotent_response(
+                provider,
+                provider.get_idempotency_key(signed_data, get_header, path),
+                compute,
+                set_header,
+            )
+        else:
+            response = await compute(set_header)
+    finally:
+        reset_deadline(token)
+    timer.done(response[0])
+    return response
+
+
+async def process_request(provider, signer, data, get_header,
+                          set_header=None, executor=None, timer=NULL_TIMER):
+    if get_header(BATCH_HEADER, None):
+        results = await asyncio.gather(*[
+            _provide_item(provider, item, executor) for item in data
+        ])
+        timer.mark('provide')
+        response_data = signer.dumps(list(results))
+        timer.mark('sign')
+        return (200, response_data)
+    try:
+        raw_response_data = await provide(provider, data, executor)
+        if get_header(STREAM_HEADER, None):
+            return (200, await stream_response(
+                provider, signer, raw_response_data, executor, timer))
+        raw_response_data = await _as_value(raw_response_data)
+    except DeadlineExceeded:
+        # Raised by the process pool once the deadline passed.
+        return (504, "Deadline exceeded")
+    except Exception:
+        provider.report_exception()
+        return (400, "Failed to process the request")
+    timer.mark('provide')
+    provider.set_response_headers(set_header, data, raw_response_data)
+    response_data = signer.dumps(raw_response_data)
+    timer.mark('sign')
+    return (200, response_data)
+
+
+def _encode_body(data):
+    if isinstance(data, list):
+        data = ', '.join(data)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return data
+
+
+def _content_type(status_code, get_header):
+    serializer = get_header(SERIALIZER_HEADER, DEFAULT_SERIALIZER)
+    if status_code == 200 and serializer in SERIALIZERS:
+        return get_content_type(serializer)
+    return 'text/plain; charset=utf-8'
+
+
+async def _send_error(send, status_code, message):
+    await send({
+        'type': 'http.response.start',
+        'status': status_code,
+        'headers': [
+            (b'content-type', b'text/plain; charset=utf-8'),
+            (b'content-length', str(len(message)).encode('latin-1')),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': message})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def provider_for_asgi(provider, executor=None,
+                      max_body_size=DEFAULT_MAX_BODY_SIZE):
+    """
+    Returns an ASGI application serving ``provider``. Requests larger than
+    ``max_body_size`` bytes are rejected with a ``413``.
+    """
+    async def provider_app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await _lifespan(receive, send)
+        headers = dict(
+            (key.decode('latin-1').lower(), value.decode('latin-1'))
+            for key, value in scope.get('headers', [])
+        )
+
+        def get_header(key, default):
+            return headers.get(key.lower(), default)
+
+        try:
+            length = int(get_header('content-length', -1))
+        except ValueError:
+            length = -1
+        if max_body_size is not None and length > max_body_size:
+            return await _send_error(send, 413, b'Request body too large')
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunk = message.get('body', b'')
+            # Chunked bodies do not announce their length.
+            size += len(chunk)
+            if max_body_size is not None and size > max_body_size:
+                return await _send_error(
+                    send, 413, b'Request body too large')
+            chunks.append(chunk)
+            more_body = message.get('more_body', False)
+        response_headers = {}
+        status_code, data = await get_response(
+            provider,
+            scope['method'],
+            b''.join(chunks),
+            get_header,
+            response_headers.__setitem__,
+            executor,
+            scope['path'],
+        )
+        if isinstance(data, AsyncResponseStream):
+            response_headers['content-type'] = data.content_type
+        else:
+            if isinstance(data, list):
+                # The allowed methods of a 405 response.
+                response_headers['allow'] = ', '.join(data)
+            data = _encode_body(data)
+            response_headers['content-type'] = _content_type(
+                status_code, get_header)
+            response_headers['content-length'] = str(len(data))
+        await send({
+            'type': 'http.response.start',
+            'status': status_code,
+            'headers': [
+                (key.encode('latin-1'), value.encode('latin-1'))
+                for key, value in response_headers.items()
+            ],
+        })
+        if not isinstance(data, AsyncResponseStream):
+            await send({'type': 'http.response.body', 'body': data})
+            return
+        try:
+            async for frame in data:
+                await send({
+                    'type': 'http.response.body',
+                    'body': frame,
+                    'more_body': True,
+                })
+        finally:
+            await data.aclose()
+        await send({'type': 'http.response.body', 'body': b''})
+    return provider_app
+
+
+def provider_for_django_async(provider, executor=None):
+    from django.http import HttpResponse, StreamingHttpResponse
+
+    async def provider_view(request, *args, **kwargs):
+        def get_header(key, default):
+            django_key = 'HTTP_%s' % key.upper().replace('-', '_')
+            return request.META.get(django_key, default)
+        headers = {}
+        status_code, data = await get_response(
+            provider,
+            request.method,
+            request.body,
+            get_header,
+            headers.__setitem__,
+            executor,
+            request.path,
+        )
+        if isinstance(data, AsyncResponseStream):
+            response = StreamingHttpResponse(
+                data, status=status_code, content_type=data.content_type)
+        else:
+            response = HttpResponse(data, status=status_code)
+        for key, value in headers.items():
+            response[key] = value
+        return response
+    provider_view.csrf_exempt = True
+    return provider_view
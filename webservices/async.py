@@ -1,69 +1,827 @@
-from twisted.internet import threads
+import threading
+import time
+from io import BytesIO
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # pragma: no cover
+    from urlparse import urlsplit
+
+from twisted.internet import defer, threads
+from twisted.internet.endpoints import UNIXClientEndpoint
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 from twisted.web import server
-from twisted.web.client import getPage
+from twisted.web.client import (
+    Agent,
+    FileBodyProducer,
+    HTTPConnectionPool,
+    PotentialDataLoss,
+    ResponseDone,
+)
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IAgentEndpointFactory
 from twisted.web.resource import Resource
+from zope.interface import implementer
+
+from webservices.deadline import reset_deadline, set_deadline
+from webservices.exceptions import (
+    DeadlineExceeded,
+    RequestRejected,
+    WebserviceError,
+)
+from webservices.metrics import NULL_TIMER
+from webservices.models import (
+    BATCH_HEADER,
+    DEADLINE_HEADER,
+    STREAM_HEADER,
+    BaseConsumer,
+    Response,
+    _as_value,
+    _join_url,
+    batch_error,
+    batch_result,
+    response_body,
+    unix_socket_path,
+)
+from webservices.streaming import ResponseStream
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('latin-1')
+
+
+class BodyReceiver(Protocol):
+    """
+    Collects a response body as it arrives, giving up once it is larger than
+    ``max_size`` bytes.
+    """
+    def __init__(self, finished, max_size=None):
+        self.finished = finished
+        self.max_size = max_size
+        self.chunks = []
+        self.size = 0
+
+    def dataReceived(self, data):
+        if self.chunks is None:
+            return
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            self.chunks = None
+            self.transport.stopProducing()
+            return
+        self.chunks.append(data)
+
+    def connectionLost(self, reason):
+        if self.chunks is None:
+            self.finished.errback(WebserviceError('Response body too large'))
+        elif reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(b''.join(self.chunks))
+        else:
+            self.finished.errback(reason)
+
+
+class FrameReceiver(Protocol):
+    """
+    Verifies the frames of a streamed response as they arrive and calls
+    ``callback`` with their items.
+    """
+    def __init__(self, finished, reader, callback):
+        self.finished = finished
+        self.reader = reader
+        self.callback = callback
+        self.failure = None
+
+    def dataReceived(self, data):
+        if self.failure is not None:
+            return
+        try:
+            for item in self.reader.feed(data):
+                self.callback(item)
+        except Exception:
+            self.failure = Failure()
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if self.failure is None and reason.check(
+                ResponseDone, PotentialDataLoss):
+            try:
+                self.reader.close()
+            except WebserviceError:
+                self.failure = Failure()
+            else:
+                self.finished.callback(None)
+                return
+        self.finished.errback(self.failure or reason)
+
 
-from webservices.exceptions import BadRequest, WebserviceError
-from webservices.models import BaseConsumer
+class DeferredGroup(object):
+    """
+    Twisted counterpart of ``webservices.singleflight.Group``: concurrent
+    calls to ``do`` with the same key share the result of a single
+    ``Deferred``.
+    """
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+
+    def do(self, key, function):
+        waiters = self._calls.get(key)
+        if waiters is not None:
+            self.shared += 1
+            waiter = defer.Deferred()
+            waiters.append(waiter)
+            return waiter
+        waiters = self._calls[key] = []
+
+        def done(result):
+            del self._calls[key]
+            for waiter in waiters:
+                waiter.callback(result)
+            return result
+        return defer.maybeDeferred(function).addBoth(done)
+
+
+@implementer(IAgentEndpointFactory)
+class UNIXEndpointFactory(object):
+    """
+    Connects to the unix socket named by the (percent encoded) host of
+    ``http+unix`` URLs.
+    """
+    def __init__(self, reactor, connect_timeout=None):
+        self.reactor = reactor
+        self.connect_timeout = connect_timeout
+
+    def endpointForURI(self, uri):
+        socket_path = unix_socket_path(uri.toBytes().decode('latin-1'))
+        if self.connect_timeout is None:
+            return UNIXClientEndpoint(self.reactor, socket_path)
+        return UNIXClientEndpoint(
+            self.reactor, socket_path, timeout=self.connect_timeout)
 
 
 class TwistedConsumer(BaseConsumer):
+    def __init__(self, base_url, public_key, private_key, pool=None,
+                 max_connections=10, timeout=None, connect_timeout=None,
+                 max_response_size=None, reactor=None, **kwargs):
+        super(TwistedConsumer, self).__init__(
+            base_url, public_key, private_key, **kwargs)
+        if reactor is None:
+            from twisted.internet import reactor
+        if pool is None:
+            pool = HTTPConnectionPool(reactor, persistent=True)
+            pool.maxPersistentPerHost = max_connections
+        self.reactor = reactor
+        self.pool = pool
+        self.agent = Agent(reactor, connectTimeout=connect_timeout, pool=pool)
+        self.unix_agent = Agent.usingEndpointFactory(
+            reactor, UNIXEndpointFactory(reactor, connect_timeout), pool=pool)
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_response_size = max_response_size
+        self._limits = {}
+        self._idempotent = False
+
+    def consume(self, path, data, max_age=None, idempotent=False):
+        """
+        Only calls made with ``idempotent=True`` are hedged, see
+        ``Balancer``.
+        """
+        # The request is sent before this returns, see send_balanced.
+        self._idempotent = idempotent
+        try:
+            return super(TwistedConsumer, self).consume(path, data, max_age)
+        finally:
+            self._idempotent = False
+
+    def get_limit(self, url):
+        # The pool only bounds idle connections, this bounds the requests in
+        # flight to each host.
+        host = urlsplit(url)[:2]
+        limit = self._limits.get(host)
+        if limit is None:
+            limit = self._limits.setdefault(
+                host, defer.DeferredSemaphore(self.max_connections))
+        return limit
+
+    def open_request(self, url, data, headers, receive):
+        """
+        Sends the request and calls ``receive`` with the response. The
+        request counts against ``max_connections`` until the ``Deferred``
+        returned by ``receive`` fired, i.e. until its body was read.
+        """
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        request_headers = Headers(dict(
+            (_to_bytes(key), [_to_bytes(value)])
+            for key, value in headers.items()
+        ))
+        agent = self.agent
+        if unix_socket_path(url) is not None:
+            agent = self.unix_agent
+        limit = self.get_limit(url)
+
+        def release(value):
+            limit.release()
+            return value
+
+        def send(_):
+            response = defer.maybeDeferred(
+                agent.request,
+                b'POST',
+                _to_bytes(url),
+                request_headers,
+                FileBodyProducer(BytesIO(data)),
+            )
+            response.addCallback(receive)
+            response.addBoth(release)
+            return response
+        return limit.acquire().addCallback(send)
+
     def send_request(self, url, data, headers):
-        return getPage(url, method='POST', postdata=data, headers=headers)
+        response = self.open_request(url, data, headers, self.read_response)
+        if self.timeout is not None:
+            response.addTimeout(self.timeout, self.reactor)
+        return response
+
+    def send_balanced(self, path, data, headers):
+        balancer = self.balancer
+        result = defer.Deferred()
+        running = [0]
+
+        def send(endpoint):
+            started = time.time()
+            running[0] += 1
+
+            def succeeded(response):
+                running[0] -= 1
+                balancer.finish(endpoint, time.time() - started, True)
+                if not result.called:
+                    result.callback(response)
+
+            def failed(failure):
+                running[0] -= 1
+                balancer.finish(
+                    endpoint,
+                    time.time() - started,
+                    balancer.is_healthy(failure.value),
+                )
+                if not result.called and not running[0]:
+                    result.errback(failure)
+
+            response = self.send_request(
+                _join_url(endpoint.base_url, path), data, headers)
+            response.addCallbacks(succeeded, failed)
+
+        try:
+            endpoint = balancer.pick()
+        except WebserviceError:
+            return defer.fail()
+        send(endpoint)
+        delay = balancer.hedge_delay() if self._idempotent else None
+        if delay is not None:
+            def hedge():
+                second = balancer.pick(exclude=[endpoint])
+                if second is not None:
+                    send(second)
+
+            call = self.reactor.callLater(delay, hedge)
+
+            def cancel(value):
+                if call.active():
+                    call.cancel()
+                return value
+            result.addBoth(cancel)
+        return result
+
+    def consume_stream(self, path, data, callback, max_age=None):
+        """
+        Calls ``callback`` with each item streamed by the provider as it
+        arrives. Returns a ``Deferred`` firing once the stream ended.
+        """
+        if not path.startswith('/'):
+            raise ValueError("Paths must start with a slash")
+
+        def receive(response):
+            if response.code >= 300:
+                return self.read_response(response)
+            finished = defer.Deferred()
+            response.deliverBody(FrameReceiver(
+                finished, self.get_frame_reader(max_age), callback))
+            return finished
+        return self.open_request(
+            self.build_url(path),
+            self.signer.dumps(data),
+            self.build_headers({STREAM_HEADER: '1'}),
+            receive,
+        )
+
+    def read_response(self, response):
+        finished = defer.Deferred()
+        response.deliverBody(BodyReceiver(finished, self.max_response_size))
 
-    def handle_response(self, response, max_age):
         def callback(body):
-            return self.signer.loads(body, max_age=max_age)
+            self.raise_for_status(response.code, body)
+            headers = dict(
+                (key.decode('latin-1').lower(), values[-1].decode('latin-1'))
+                for key, values in response.headers.getAllRawHeaders()
+            )
+            return Response(body, headers)
+        finished.addCallback(callback)
+        return finished
 
-        def errback(fail):
-            message = fail.value.message
-            status_code = fail.value.status
-            self.raise_for_status(int(status_code), message)
+    def handle_response(self, response, max_age):
+        def callback(body):
+            return self.signer.loads(response_body(body), max_age=max_age)
         response.addCallback(callback)
-        response.addErrback(errback)
         return response
 
-    def raise_for_status(self, status_code, message):
-        if status_code == 400:
-            raise BadRequest(message)
-        elif status_code >= 300:
-            raise WebserviceError(message)
+    def add_callback(self, result, callback):
+        result.addCallback(callback)
+        return result
+
+    def as_result(self, value):
+        return defer.succeed(value)
+
+    def make_call_group(self):
+        return DeferredGroup()
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+
+class PoolStats(object):
+    """
+    Counters of a ``ProviderResource``'s worker pool. Times are totals in
+    seconds.
+    """
+    def __init__(self):
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.execution_time = 0.0
+        self._lock = threading.Lock()
+
+    def submitted(self):
+        with self._lock:
+            self.queued += 1
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def started(self, wait_time):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.wait_time += wait_time
+
+    def finished(self, execution_time):
+        with self._lock:
+            self.running -= 1
+            self.completed += 1
+            self.execution_time += execution_time
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'wait_time': self.wait_time,
+                'execution_time': self.execution_time,
+            }
+
+
+def _report_failure(provider, failure):
+    # report_exception looks at sys.exc_info()
+    try:
+        failure.raiseException()
+    except Exception:
+        provider.report_exception()
+
+
+def provide(provider, data, deadline=None, defer_to_thread=None):
+    """
+    Calls ``provide`` on the reactor with ``deadline`` set, its result may be
+    a ``Deferred``. Worker processes are waited for in a thread, using
+    ``defer_to_thread`` (defaults to ``deferToThread``) to run it.
+    """
+    if defer_to_thread is None:
+        defer_to_thread = threads.deferToThread
+    token = set_deadline(deadline)
+    try:
+        if provider.processes:
+            return defer_to_thread(provider.process_pool.submit(data))
+        return defer.maybeDeferred(provider.provide, data)
+    finally:
+        reset_deadline(token)
+
+
+def get_idempotent_response(provider, key, compute, set_header=None):
+    """
+    Twisted version of ``Provider.get_idempotent_response``, ``compute``
+    must return a ``Deferred``.
+    """
+    def compute_entry():
+        headers = {}
+
+        def computed(response):
+            status_code, response_data = response
+            entry = (status_code, response_data, headers)
+            if status_code == 200:
+                provider.idempotency_cache.set(key, entry)
+            return entry
+        return compute(headers.__setitem__).addCallback(computed)
+
+    def respond(entry):
+        status_code, response_data, headers = entry
+        if set_header is not None:
+            for header, value in headers.items():
+                set_header(header, value)
+        return status_code, response_data
+
+    entry = provider.idempotency_cache.get(key)
+    if entry is None:
+        calls = provider.__dict__.setdefault(
+            '_twisted_idempotency_calls', DeferredGroup())
+        return calls.do(key, compute_entry).addCallback(respond)
+    return defer.succeed(respond(entry))
+
+
+def get_response(provider, method, signed_data, get_header, set_header=None,
+                 path=None, defer_to_thread=None):
+    """
+    Version of ``Provider.get_response`` running on the reactor and returning
+    a ``Deferred``. ``provide`` may return a ``Deferred`` and must not block.
+    """
+    timer = provider.get_timer(get_header)
+    deadline = provider.get_deadline(get_header)
+    try:
+        provider.check_deadline(deadline)
+        target = provider.get_provider(path)
+        if target is None:
+            raise RequestRejected(404, "Not found")
+        signer, data = provider.load_request(
+            method, signed_data, get_header, timer)
+        provider.check_deadline(deadline)
+    except RequestRejected as rejected:
+        timer.done(rejected.response[0])
+        return defer.succeed(rejected.response)
+
+    def compute(set_header):
+        return process_request(
+            target, signer, data, get_header, set_header, deadline, timer,
+            defer_to_thread)
+
+    def done(response):
+        timer.done(response[0])
+        return response
+
+    if provider.idempotency_window and not get_header(STREAM_HEADER, None):
+        deferred = get_idempotent_response(
+            provider,
+            provider.get_idempotency_key(signed_data, get_header, path),
+            compute,
+            set_header,
+        )
+    else:
+        deferred = compute(set_header)
+    return deferred.addCallback(done)
+
+
+def process_request(provider, signer, data, get_header, set_header=None,
+                    deadline=None, timer=NULL_TIMER, defer_to_thread=None):
+    if get_header(BATCH_HEADER, None):
+        return get_batch_response(
+            provider, signer, data, deadline, timer, defer_to_thread)
+
+    def provided(raw_response_data):
+        token = set_deadline(deadline)
+        try:
+            if get_header(STREAM_HEADER, None):
+                return (200, provider.stream_response(
+                    signer, raw_response_data, timer))
+            raw_response_data = _as_value(raw_response_data)
+        except Exception:
+            provider.report_exception()
+            return (400, "Failed to process the request")
+        finally:
+            reset_deadline(token)
+        timer.mark('provide')
+        provider.set_response_headers(set_header, data, raw_response_data)
+        response_data = signer.dumps(raw_response_data)
+        timer.mark('sign')
+        return (200, response_data)
+
+    def failed(failure):
+        if failure.check(DeadlineExceeded):
+            # Raised by the process pool once the deadline passed.
+            return (504, "Deadline exceeded")
+        _report_failure(provider, failure)
+        return (400, "Failed to process the request")
+
+    deferred = provide(provider, data, deadline, defer_to_thread)
+    return deferred.addCallbacks(provided, failed)
+
+
+def get_batch_response(provider, signer, items, deadline=None,
+                       timer=NULL_TIMER, defer_to_thread=None):
+    def provide_item(item):
+        if deadline is not None and deadline <= time.time():
+            return defer.succeed(batch_error("Deadline exceeded", 504))
+
+        def failed(failure):
+            if failure.check(DeadlineExceeded):
+                return batch_error("Deadline exceeded", 504)
+            _report_failure(provider, failure)
+            return batch_error("Failed to process the request")
+        deferred = provide(provider, item, deadline, defer_to_thread)
+        deferred.addCallback(lambda result: batch_result(_as_value(result)))
+        return deferred.addErrback(failed)
+
+    def sign(results):
+        timer.mark('provide')
+        response_data = signer.dumps(results)
+        timer.mark('sign')
+        return (200, response_data)
+
+    return defer.gatherResults(
+        [provide_item(item) for item in items]).addCallback(sign)
 
 
 class ProviderResource(Resource):
+    """
+    Serves ``provider`` from a thread pool. With ``threaded=False`` requests
+    are processed on the reactor instead, see ``get_response``.
+    """
     isLeaf = True
 
-    def __init__(self, provider):
+    def __init__(self, provider, streaming=False, max_body_size=None,
+                 pool_size=None, max_queue=None, retry_after=1,
+                 threaded=True):
+        if streaming and not threaded:
+            raise ValueError('streaming requires threaded=True')
         self.provider = provider
+        self.threaded = threaded
+        self.streaming = streaming
+        self.max_body_size = max_body_size
+        self.pool_size = pool_size
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.stats = PoolStats()
+        self.pool = None
+        self._shutdown_trigger = None
         Resource.__init__(self)
 
+    def get_pool(self):
+        if self.pool is None:
+            from twisted.internet import reactor
+            self.pool = ThreadPool(
+                minthreads=0,
+                maxthreads=self.pool_size,
+                name='ProviderResource-%s' % type(self.provider).__name__,
+            )
+            self.pool.start()
+            self._shutdown_trigger = reactor.addSystemEventTrigger(
+                'during', 'shutdown', self.stop)
+        return self.pool
+
+    def stop(self):
+        """
+        Stops the threads of the resource's own pool (see ``pool_size``),
+        which is otherwise only stopped when the reactor shuts down. A new
+        pool is started by the next request.
+        """
+        if self.pool is None:
+            return
+        from twisted.internet import reactor
+        pool, self.pool = self.pool, None
+        trigger, self._shutdown_trigger = self._shutdown_trigger, None
+        if trigger is not None:
+            try:
+                reactor.removeSystemEventTrigger(trigger)
+            except ValueError:
+                # Already fired, we are being called by it.
+                pass
+        pool.stop()
+
+    def run_in_pool(self, function, *args):
+        stats = self.stats
+        submitted = time.time()
+
+        def run():
+            started = time.time()
+            stats.started(started - submitted)
+            try:
+                return function(*args)
+            finally:
+                stats.finished(time.time() - started)
+
+        stats.submitted()
+        return self.defer_to_pool(run)
+
+    def defer_to_pool(self, function, *args):
+        if self.pool_size is None:
+            return threads.deferToThread(function, *args)
+        from twisted.internet import reactor
+        return threads.deferToThreadPool(
+            reactor, self.get_pool(), function, *args)
+
+    def write_stream(self, request, stream):
+        """
+        Writes the frames of ``stream`` as they are produced in the pool.
+        """
+        frames = iter(stream)
+        gone = []
+        request.notifyFinish().addErrback(gone.append)
+
+        def write(frame):
+            if gone:
+                self.defer_to_pool(stream.close)
+            elif frame is None:
+                request.finish()
+            else:
+                request.write(frame)
+                next_frame()
+
+        def failed(failure):
+            # Consumers notice the missing end of the stream.
+            if not gone:
+                request.finish()
+            return failure
+
+        def next_frame():
+            deferred = self.defer_to_pool(next, frames, None)
+            deferred.addCallbacks(write, failed)
+
+        next_frame()
+
+    def is_overloaded(self):
+        return self.max_queue is not None and (
+            self.stats.queued >= self.max_queue)
+
+    def get_body_size(self, request):
+        length = request.getHeader('content-length')
+        if length is not None:
+            return int(length)
+        request.content.seek(0, 2)
+        return request.content.tell()
+
     def render_POST(self, request):
+        received = time.time()
+
         def get_header(key, default):
-            return request.getHeader(key) or default
+            value = request.getHeader(key) or default
+            if key == DEADLINE_HEADER and value is not None:
+                # Time spent waiting for a worker counts against the deadline.
+                try:
+                    value = '%.3f' % (float(value) - (time.time() - received))
+                except ValueError:
+                    pass
+            return value
+
+        headers = {}
+        path = request.path.decode('latin-1')
 
         def callback(info):
             status_code, data = info
+            for key, value in headers.items():
+                request.setHeader(key, value)
             request.setResponseCode(status_code)
+            if isinstance(data, ResponseStream):
+                request.setHeader('content-type', data.content_type)
+                return self.write_stream(request, data)
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
             request.write(data)
             request.finish()
 
-        # XXX: This is not the correct way to pass the data to the processing
-        #      function. The content is read from disk and could be too large
-        #      to fit into memory. The correct way to go is to pass an open
-        #      file handler as argument instead of a single string, but this
-        #      would require each provider to be adapted.
-        request.content.seek(0)
-        signed_data = request.content.read()
-
-        deferred = threads.deferToThread(
-            self.provider.get_response,
-            'POST',
-            signed_data,
-            get_header,
-        )
+        if (self.max_body_size is not None and
+                self.get_body_size(request) > self.max_body_size):
+            request.setResponseCode(413)
+            return b'Request body too large'
+
+        if self.is_overloaded():
+            self.stats.reject()
+            request.setResponseCode(503)
+            request.setHeader('Retry-After', str(self.retry_after))
+            return b'Service unavailable'
+
+        if self.streaming:
+            # The body is verified chunk by chunk and handed to the provider
+            # as a file like object, see Provider.provide_stream.
+            deferred = self.run_in_pool(
+                self.provider.get_stream_response,
+                'POST',
+                request.content,
+                get_header,
+                headers.__setitem__,
+                path,
+            )
+        else:
+            # This reads the whole body into memory, use streaming=True for
+            # large payloads.
+            request.content.seek(0)
+            signed_data = request.content.read()
+            if self.threaded:
+                deferred = self.run_in_pool(
+                    self.provider.get_response,
+                    'POST',
+                    signed_data,
+                    get_header,
+                    headers.__setitem__,
+                    path,
+                )
+            else:
+                deferred = get_response(
+                    self.provider,
+                    'POST',
+                    signed_data,
+                    get_header,
+                    headers.__setitem__,
+                    path,
+                    # Waiting for worker processes counts as pool work.
+                    self.run_in_pool,
+                )
         deferred.addCallback(callback)
         return server.NOT_DONE_YET
 
 
-def provider_for_twisted(provider):
-    return ProviderResource(provider)
+class LimitedRequest(server.Request):
+    """
+    Rejects bodies larger than the root resource's ``max_body_size`` with a
+    ``413`` while they arrive, rather than after they were buffered.
+    ``ProviderResource.render_POST`` still checks bodies that got through,
+    e.g. with resources nested below the root.
+    """
+    rejected = False
+
+    def get_max_body_size(self):
+        return getattr(self.channel.site.resource, 'max_body_size', None)
+
+    def reject_body(self):
+        self.rejected = True
+        transport = self.channel.transport
+        transport.write(
+            b'HTTP/1.1 413 Request Entity Too Large\r\n'
+            b'Content-Length: 22\r\n'
+            b'Connection: close\r\n'
+            b'\r\n'
+            b'Request body too large'
+        )
+        transport.loseConnection()
+
+    def gotLength(self, length):
+        self.body_size = 0
+        self.max_body_size = self.get_max_body_size()
+        if (length is not None and self.max_body_size is not None and
+                length > self.max_body_size):
+            self.reject_body()
+            length = 0
+        server.Request.gotLength(self, length)
+
+    def handleContentChunk(self, data):
+        if self.rejected:
+            return
+        # Chunked bodies do not announce their length.
+        self.body_size += len(data)
+        if (self.max_body_size is not None and
+                self.body_size > self.max_body_size):
+            self.reject_body()
+            return
+        server.Request.handleContentChunk(self, data)
+
+    def requestReceived(self, command, path, version):
+        if not self.rejected:
+            server.Request.requestReceived(self, command, path, version)
+
+
+class ProviderSite(server.Site):
+    """
+    ``Site`` enforcing ``max_body_size`` while request bodies arrive, see
+    ``LimitedRequest``.
+    """
+    requestFactory = LimitedRequest
+
+
+def provider_for_twisted(provider, **kwargs):
+    return ProviderResource(provider, **kwargs)
+
+
+def listen_unix(resource, path, mode=0o666, reactor=None):
+    """
+    Serves ``resource`` (see ``provider_for_twisted``) on the unix socket
+    ``path`` for ``http+unix`` consumers on the same host. A ``.lock`` file
+    next to the socket lets a restarted server replace a stale socket.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    return reactor.listenUNIX(path, ProviderSite(resource), mode=mode,
+                              wantPID=True)
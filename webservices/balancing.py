@@ -0,0 +1,115 @@
+import random
+import threading
+import time
+from collections import deque
+
+from webservices.exceptions import DeadlineExceeded, WebserviceError
+
+
+class Endpoint(object):
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.outstanding = 0
+        self.failures = 0
+        self.open_until = None
+        self.probing = False
+
+    def __repr__(self):
+        return '<Endpoint %s>' % self.base_url
+
+
+class Balancer(object):
+    """
+    Spreads requests over several replicas of a provider, sending each to
+    the one with the fewest requests in flight.
+
+    Hosts failing ``failure_threshold`` times in a row (connection errors
+    and ``5xx`` responses) are left alone for ``reset_timeout`` seconds,
+    after which a single request is let through to probe them.
+
+    With ``hedge_percentile``, a request still running after that
+    percentile of the recent latencies is sent to a second replica as
+    well, and the first response wins. Only use it for idempotent calls.
+    """
+    def __init__(self, base_urls=(), failure_threshold=5, reset_timeout=30,
+                 hedge_percentile=None, hedge_min_samples=20,
+                 latency_window=256, clock=time.time):
+        self.endpoints = []
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = deque(maxlen=latency_window)
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.add(*base_urls)
+
+    def add(self, *base_urls):
+        with self._lock:
+            for base_url in base_urls:
+                self.endpoints.append(Endpoint(base_url))
+
+    def is_available(self, endpoint, now):
+        if endpoint.open_until is None:
+            return True
+        return endpoint.open_until <= now and not endpoint.probing
+
+    def pick(self, exclude=()):
+        """
+        Returns the endpoint for the next request and counts it as in
+        flight, ``finish`` must be called once it completed.
+        """
+        with self._lock:
+            now = self.clock()
+            candidates = [
+                endpoint for endpoint in self.endpoints
+                if endpoint not in exclude and
+                self.is_available(endpoint, now)
+            ]
+            if not candidates:
+                if exclude:
+                    return None
+                raise WebserviceError('No healthy endpoints')
+            least = min(endpoint.outstanding for endpoint in candidates)
+            endpoint = random.choice([
+                endpoint for endpoint in candidates
+                if endpoint.outstanding == least
+            ])
+            if endpoint.open_until is not None:
+                endpoint.probing = True
+            endpoint.outstanding += 1
+            return endpoint
+
+    def finish(self, endpoint, latency, healthy):
+        with self._lock:
+            endpoint.outstanding -= 1
+            endpoint.probing = False
+            if healthy:
+                endpoint.failures = 0
+                endpoint.open_until = None
+                self.latencies.append(latency)
+                return
+            endpoint.failures += 1
+            if (endpoint.open_until is not None or
+                    endpoint.failures >= self.failure_threshold):
+                endpoint.open_until = self.clock() + self.reset_timeout
+
+    def is_healthy(self, exc):
+        """
+        Whether the host answering with ``exc`` should count as healthy.
+        Errors from the provider (``4xx`` responses) do.
+        """
+        if not isinstance(exc, WebserviceError) or isinstance(
+                exc, DeadlineExceeded):
+            return False
+        return getattr(exc, 'status_code', 0) < 500
+
+    def hedge_delay(self):
+        if self.hedge_percentile is None or len(self.endpoints) < 2:
+            return None
+        with self._lock:
+            if len(self.latencies) < self.hedge_min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        index = int(len(latencies) * self.hedge_percentile / 100.0)
+        return latencies[min(index, len(latencies) - 1)]
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+MISSING = object()
+
+
+def make_key(*parts):
+    """
+    Stable digest of JSON like ``parts``, independent of dictionary order.
+    """
+    canonical = json.dumps(
+        parts, sort_keys=True, separators=(',', ':'), default=repr)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+class LRUCache(object):
+    """
+    Thread safe, size bounded LRU cache. Entries optionally expire after
+    ``ttl`` seconds. If ``max_bytes`` is set, the total ``sizeof`` of all
+    values is kept below it as well.
+    """
+    def __init__(self, max_size=1024, ttl=None, clock=time.time,
+                 max_bytes=None, sizeof=len):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires, size = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= self.clock():
+                self.bytes -= size
+                self.misses += 1
+                return default
+            self._data[key] = (value, expires, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        if self.max_size <= 0:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else self.clock() + ttl
+        size = 0 if self.max_bytes is None else self.sizeof(value)
+        with self._lock:
+            self._pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._data[key] = (value, expires, size)
+            self.bytes += size
+            while len(self._data) > self.max_size or (
+                    self.max_bytes is not None and
+                    self.bytes > self.max_bytes):
+                _, (_, _, evicted_size) = self._data.popitem(last=False)
+                self.bytes -= evicted_size
+
+    def _pop(self, key):
+        try:
+            _, _, size = self._data.pop(key)
+        except KeyError:
+            return
+        self.bytes -= size
+
+    def invalidate(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+        }
+
+
+def _dump_entry(expires, value):
+    # A header line with the kind of value and its expiry, then the value.
+    if isinstance(value, bytes):
+        kind = 'b'
+    else:
+        try:
+            value = value.encode('utf-8')
+        except AttributeError:
+            raise TypeError('FileCache only stores bytes and text')
+        kind = 't'
+    header = '%s %s\n' % (kind, '-' if expires is None else repr(expires))
+    return header.encode('ascii') + value
+
+
+def _load_entry(entry):
+    header, newline, value = entry.partition(b'\n')
+    kind, _, expires = header.decode('ascii').partition(' ')
+    if not newline or kind not in ('b', 't'):
+        raise ValueError('Invalid cache entry')
+    expires = None if expires == '-' else float(expires)
+    if kind == 't':
+        value = value.decode('utf-8')
+    return expires, value
+
+
+class FileCache(object):
+    """
+    Cache storing its entries as files in ``directory``, so it can be shared
+    between processes (point it to a tmpfs such as ``/dev/shm`` to keep it
+    in memory). At most ``max_size`` entries are kept, the least recently
+    used ones are evicted first.
+
+    Keys must be valid file names, such as the digests of ``make_key``.
+    Values must be bytes or text: files hold the expiry and the raw value,
+    nothing read from them is ever unpickled.
+    """
+    suffix = '.cache'
+
+    def __init__(self, directory, max_size=1024, ttl=None, clock=time.time):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def _entries(self):
+        return [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(self.suffix)
+        ]
+
+    def __len__(self):
+        return len(self._entries())
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fobj:
+                expires, value = _load_entry(fobj.read())
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return default
+        if expires is not None and expires <= self.clock():
+            self.invalidate(key)
+            self.misses += 1
+            return default
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        if self.max_size <= 0:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else self.clock() + ttl
+        entry = _dump_entry(expires, value)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as fobj:
+            fobj.write(entry)
+        os.rename(temp_path, self._path(key))
+        self._evict()
+
+    def _evict(self):
+        entries = self._entries()
+        if len(entries) <= self.max_size:
+            return
+        by_age = []
+        for path in entries:
+            try:
+                by_age.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        by_age.sort()
+        for _, path in by_age[:len(by_age) - self.max_size]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def invalidate(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self),
+        }
@@ -0,0 +1,72 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+DEFAULT_THRESHOLD = 1024
+# Marks payloads which were below the threshold and sent uncompressed.
+RAW_FLAG = b'0'
+
+CODECS = {}
+DECOMPRESSORS = {}
+
+
+def register_codec(name, flag, compress, decompress):
+    """
+    Registers a compression codec under ``name``. ``flag`` is a single byte
+    prefixed to payloads compressed with this codec.
+    """
+    CODECS[name] = (flag, compress)
+    DECOMPRESSORS[flag] = decompress
+
+
+def available_codecs():
+    return sorted(CODECS)
+
+
+class CompressedPayload(object):
+    """
+    Wraps a payload serializer and compresses its output with ``codec`` if
+    it is at least ``threshold`` bytes long. Compression happens before
+    signing, so signatures are always verified before decompressing.
+    """
+    def __init__(self, serializer, codec, threshold=DEFAULT_THRESHOLD):
+        self.serializer = serializer
+        self.flag, self.compress = CODECS[codec]
+        self.threshold = threshold
+
+    def dumps(self, obj):
+        data = self.serializer.dumps(obj)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        if len(data) < self.threshold:
+            return RAW_FLAG + data
+        return self.flag + self.compress(data)
+
+    def loads(self, data):
+        flag, data = data[:1], data[1:]
+        if flag != RAW_FLAG:
+            data = DECOMPRESSORS[flag](data)
+        return self.serializer.loads(data)
+
+
+register_codec('zlib', b'z', zlib.compress, zlib.decompress)
+
+if zstandard is not None:
+    register_codec(
+        'zstd',
+        b's',
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+if brotli is not None:
+    register_codec('brotli', b'b', brotli.compress, brotli.decompress)
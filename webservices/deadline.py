@@ -0,0 +1,84 @@
+"""
+Deadline of the request being processed, so ``provide`` can stop working
+on requests the consumer will not wait for::
+
+    from webservices.deadline import remaining
+
+    class SearchProvider(Provider):
+        def provide(self, data):
+            results = []
+            for shard in SHARDS:
+                budget = remaining()
+                if budget is not None and budget < 0.05:
+                    break
+                results.extend(shard.search(data['query'], timeout=budget))
+            return results
+"""
+import threading
+import time
+
+try:
+    import contextvars
+except ImportError:  # pragma: no cover
+    # python < 3.7
+    contextvars = None
+
+
+if contextvars is not None:
+    _deadline = contextvars.ContextVar('webservices_deadline', default=None)
+
+    def get_deadline():
+        return _deadline.get()
+
+    def set_deadline(deadline):
+        return _deadline.set(deadline)
+
+    def reset_deadline(token):
+        _deadline.reset(token)
+else:  # pragma: no cover
+    _local = threading.local()
+
+    def get_deadline():
+        return getattr(_local, 'deadline', None)
+
+    def set_deadline(deadline):
+        token = get_deadline()
+        _local.deadline = deadline
+        return token
+
+    def reset_deadline(token):
+        _local.deadline = token
+
+
+def remaining():
+    """
+    Seconds left until the consumer stops waiting for the current request,
+    ``None`` if it did not send a deadline.
+    """
+    deadline = get_deadline()
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), 0.0)
+
+
+def expired():
+    deadline = get_deadline()
+    return deadline is not None and deadline <= time.time()
+
+
+def copy_context():
+    """
+    Returns a function calling its arguments in the current context, to
+    keep the deadline when running code in other threads.
+    """
+    if contextvars is not None:
+        return contextvars.copy_context().run
+    deadline = get_deadline()
+
+    def run(function, *args):  # pragma: no cover
+        token = set_deadline(deadline)
+        try:
+            return function(*args)
+        finally:
+            reset_deadline(token)
+    return run
@@ -4,3 +4,13 @@ class WebserviceError(Exception):
 
 class BadRequest(WebserviceError):
     pass
+
+
+class DeadlineExceeded(WebserviceError):
+    pass
+
+
+class RequestRejected(Exception):
+    def __init__(self, status_code, message):
+        super(RequestRejected, self).__init__(message)
+        self.response = (status_code, message)
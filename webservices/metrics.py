@@ -0,0 +1,171 @@
+import bisect
+import threading
+import time
+
+
+# Public key label of provider requests until their key was accepted, so
+# made up keys do not each add a series.
+INVALID_KEY = 'invalid'
+
+# Upper bounds (in seconds) of the histogram buckets of ``Collector``.
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+
+class Instrumentation(object):
+    """
+    Receives the timings and status codes of requests. ``side`` is either
+    ``'provider'`` or ``'consumer'``. Provider phases are ``key``, ``verify``,
+    ``provide`` and ``sign`` (and ``pickle``, part of ``provide``, with
+    worker processes), consumer phases are ``sign``, ``network`` and
+    ``verify``.
+
+    Subclasses implement ``observe`` and ``count``, see ``Collector``.
+    """
+    def timer(self, side, public_key=None):
+        return Timer(self, side, public_key)
+
+    def observe(self, side, phase, seconds):
+        pass
+
+    def count(self, side, status_code, public_key=None):
+        pass
+
+
+class NullInstrumentation(Instrumentation):
+    """
+    Default instrumentation, does not even read the clock.
+    """
+    def timer(self, side, public_key=None):
+        return NULL_TIMER
+
+
+class Timer(object):
+    def __init__(self, instrumentation, side, public_key=None,
+                 clock=time.time):
+        self.instrumentation = instrumentation
+        self.side = side
+        self.public_key = public_key
+        self.clock = clock
+        self.last = clock()
+
+    def mark(self, phase):
+        """
+        Records the time since the previous mark as the time spent in
+        ``phase``.
+        """
+        now = self.clock()
+        self.instrumentation.observe(self.side, phase, now - self.last)
+        self.last = now
+
+    def set_public_key(self, public_key):
+        self.public_key = public_key
+
+    def done(self, status_code):
+        self.instrumentation.count(self.side, status_code, self.public_key)
+
+
+class NullTimer(object):
+    def mark(self, phase):
+        pass
+
+    def set_public_key(self, public_key):
+        pass
+
+    def done(self, status_code):
+        pass
+
+
+NULL_TIMER = NullTimer()
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+def _labels(**labels):
+    return ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items())
+    )
+
+
+class Collector(Instrumentation):
+    """
+    In-process collector keeping a histogram per side and phase and a count
+    per side, status code and public key. ``render`` returns them in the
+    Prometheus text format.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS, namespace='webservices'):
+        self.buckets = tuple(buckets)
+        self.namespace = namespace
+        self.histograms = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def observe(self, side, phase, seconds):
+        with self._lock:
+            histogram = self.histograms.get((side, phase))
+            if histogram is None:
+                histogram = self.histograms[side, phase] = Histogram(
+                    self.buckets)
+            histogram.observe(seconds)
+
+    def count(self, side, status_code, public_key=None):
+        key = (side, status_code, public_key or '')
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counts.clear()
+
+    def render(self):
+        seconds = '%s_phase_seconds' % self.namespace
+        requests = '%s_requests_total' % self.namespace
+        lines = [
+            '# HELP %s Time spent in each phase of a request.' % seconds,
+            '# TYPE %s histogram' % seconds,
+        ]
+        with self._lock:
+            for (side, phase), histogram in sorted(self.histograms.items()):
+                for bound, count in histogram.cumulative():
+                    lines.append('%s_bucket{%s} %d' % (
+                        seconds,
+                        _labels(side=side, phase=phase, le=bound),
+                        count,
+                    ))
+                labels = _labels(side=side, phase=phase)
+                lines.append('%s_sum{%s} %r' % (
+                    seconds, labels, histogram.sum))
+                lines.append('%s_count{%s} %d' % (
+                    seconds, labels, histogram.count))
+            lines.append(
+                '# HELP %s Requests by status code and public key.' % requests)
+            lines.append('# TYPE %s counter' % requests)
+            for (side, status_code, public_key), count in sorted(
+                    self.counts.items()):
+                lines.append('%s{%s} %d' % (requests, _labels(
+                    side=side, status=status_code, public_key=public_key,
+                ), count))
+        return '\n'.join(lines) + '\n'
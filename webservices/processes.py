@@ -0,0 +1,97 @@
+"""
+Runs ``provide`` in worker processes, for CPU bound providers which would
+otherwise be limited to a single core by the GIL. See ``Provider.processes``.
+"""
+import multiprocessing
+import pickle
+import time
+
+try:
+    from collections.abc import Iterator
+except ImportError:  # pragma: no cover
+    # python 2
+    from collections import Iterator
+
+from webservices.deadline import (
+    expired,
+    get_deadline,
+    reset_deadline,
+    set_deadline,
+)
+from webservices.exceptions import DeadlineExceeded
+
+# The copy of the provider held by a worker process.
+_provider = None
+
+
+def _init_worker(provider):
+    global _provider
+    _provider = provider
+    provider.init_worker()
+
+
+def _provide(payload):
+    data, deadline = pickle.loads(payload)
+    token = set_deadline(deadline)
+    try:
+        if expired():
+            raise DeadlineExceeded('Deadline exceeded')
+        response_data = _provider.provide(data)
+        # Generators can not be sent back, their items are.
+        streamed = isinstance(response_data, Iterator)
+        if streamed:
+            response_data = list(response_data)
+    finally:
+        reset_deadline(token)
+    return pickle.dumps((streamed, response_data), pickle.HIGHEST_PROTOCOL)
+
+
+class ProcessPool(object):
+    """
+    ``multiprocessing.Pool`` of ``processes`` workers, each with its own
+    copy of ``provider`` which is set up once by ``init_worker``. Workers
+    are replaced after ``max_tasks`` calls if given.
+
+    Only the verified data is sent to the workers, time spent pickling it
+    and the results is reported as the ``pickle`` phase of the provider.
+    """
+    def __init__(self, provider, processes=None, max_tasks=None):
+        self.instrumentation = provider.instrumentation
+        self.pool = multiprocessing.Pool(
+            processes, _init_worker, (provider,), max_tasks)
+
+    def submit(self, data):
+        """
+        Sends ``data`` to a worker and returns a function waiting for (and
+        returning) the result of its ``provide``, or raising its exception.
+        Waiting gives up once the deadline of the request passed.
+        """
+        deadline = get_deadline()
+        started = time.time()
+        payload = pickle.dumps((data, deadline), pickle.HIGHEST_PROTOCOL)
+        pickling = time.time() - started
+        pending = self.pool.apply_async(_provide, (payload,))
+
+        def result():
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0)
+            try:
+                response = pending.get(timeout)
+            except multiprocessing.TimeoutError:
+                raise DeadlineExceeded('Deadline exceeded')
+            started = time.time()
+            streamed, response_data = pickle.loads(response)
+            self.instrumentation.observe(
+                'provider', 'pickle', pickling + time.time() - started)
+            if streamed:
+                return iter(response_data)
+            return response_data
+        return result
+
+    def provide(self, data):
+        return self.submit(data)()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
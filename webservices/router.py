@@ -0,0 +1,39 @@
+from webservices.models import Provider
+
+
+class ProviderRouter(Provider):
+    """
+    Serves several providers from a single view or resource. Requests are
+    verified by the router, using its ``get_private_key`` and settings such
+    as ``max_age``, ``max_batch_size`` and ``idempotency_window``, and then
+    handed to the provider mounted at their path.
+
+    ``providers`` maps paths (relative to ``prefix``) to providers.
+    """
+    def __init__(self, providers=None, prefix='/'):
+        self.prefix = prefix.strip('/')
+        self.routes = {}
+        for path, provider in (providers or {}).items():
+            self.mount(path, provider)
+
+    def mount(self, path, provider):
+        self.routes[path.strip('/')] = provider
+
+    def get_provider(self, path):
+        if path is None:
+            return None
+        path = path.strip('/')
+        if self.prefix:
+            if not path.startswith(self.prefix):
+                return None
+            path = path[len(self.prefix):]
+            if path and not path.startswith('/'):
+                return None
+            path = path.lstrip('/')
+        return self.routes.get(path)
+
+    def provide(self, data):
+        raise NotImplementedError(
+            'ProviderRouter dispatches to the provider mounted at the path '
+            'of the request'
+        )
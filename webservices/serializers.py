@@ -0,0 +1,180 @@
+import hashlib
+import hmac
+import json
+import struct
+import time
+
+from itsdangerous import (
+    BadPayload,
+    BadSignature,
+    SignatureExpired,
+    TimedSerializer,
+)
+try:
+    from itsdangerous.encoding import want_bytes
+except ImportError:  # pragma: no cover
+    # itsdangerous < 1.0
+    from itsdangerous import want_bytes
+
+from webservices.compression import CompressedPayload, DEFAULT_THRESHOLD
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+DEFAULT_SERIALIZER = 'json'
+
+SERIALIZERS = {}
+
+
+def register_serializer(name, payload=None, signer_class=TimedSerializer,
+                        content_type='application/json'):
+    """
+    Registers a serializer under ``name``.
+
+    ``payload`` is an object with ``dumps(obj)`` and ``loads(data)`` methods
+    used to (de)serialize the data, ``None`` uses the itsdangerous default.
+    ``signer_class`` is instantiated with a private key and the payload
+    serializer and signs the serialized data, it must raise itsdangerous'
+    ``BadSignature`` and ``SignatureExpired`` like ``TimedSerializer``.
+    """
+    SERIALIZERS[name] = (payload, signer_class, content_type)
+
+
+def get_serializer(name, private_key, compression=None,
+                   compression_threshold=DEFAULT_THRESHOLD):
+    payload, signer_class, _ = SERIALIZERS[name]
+    if compression is not None:
+        payload = CompressedPayload(
+            payload or JSONPayload(), compression, compression_threshold)
+    if payload is None:
+        return signer_class(private_key)
+    return signer_class(private_key, serializer=payload)
+
+
+def get_content_type(name):
+    _, _, content_type = SERIALIZERS[name]
+    return content_type
+
+
+def available_serializers():
+    return sorted(SERIALIZERS)
+
+
+class SignerSet(object):
+    """
+    Signers for a single private key, created on first use for each
+    serializer and compression.
+    """
+    def __init__(self, private_key, compression_threshold=DEFAULT_THRESHOLD):
+        self.private_key = private_key
+        self.compression_threshold = compression_threshold
+        self._signers = {}
+
+    def get(self, name, compression=None):
+        key = (name, compression)
+        signer = self._signers.get(key)
+        if signer is None:
+            signer = self._signers.setdefault(key, get_serializer(
+                name,
+                self.private_key,
+                compression,
+                self.compression_threshold,
+            ))
+        return signer
+
+
+class JSONPayload(object):
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data.decode('utf-8'))
+
+
+class OrjsonPayload(object):
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class MsgpackPayload(object):
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class BinaryTimedSerializer(object):
+    """
+    Compact binary alternative to ``TimedSerializer``: the payload is
+    followed by an 8 byte timestamp and the raw HMAC of both, without any
+    base64 encoding or separators.
+    """
+    digest_method = staticmethod(hashlib.sha1)
+    salt = b'webservices.binary'
+    timestamp_format = '>Q'
+
+    def __init__(self, secret_key, serializer=None):
+        self.serializer = serializer or MsgpackPayload()
+        self.key = self.digest_method(
+            self.salt + b'signer' + want_bytes(secret_key)).digest()
+        self.digest_size = self.digest_method().digest_size
+        self.timestamp_size = struct.calcsize(self.timestamp_format)
+
+    def get_signature(self, value):
+        return hmac.new(self.key, value, self.digest_method).digest()
+
+    def dumps(self, obj):
+        value = want_bytes(self.serializer.dumps(obj))
+        value += struct.pack(self.timestamp_format, int(time.time()))
+        return value + self.get_signature(value)
+
+    def loads(self, data, max_age=None):
+        data = want_bytes(data)
+        if len(data) < self.timestamp_size + self.digest_size:
+            raise BadSignature('Value too short')
+        value = data[:-self.digest_size]
+        signature = data[-self.digest_size:]
+        if not hmac.compare_digest(self.get_signature(value), signature):
+            raise BadSignature('Signature does not match')
+        timestamp, = struct.unpack(
+            self.timestamp_format, value[-self.timestamp_size:])
+        if max_age is not None:
+            age = int(time.time()) - timestamp
+            if age > max_age or age < 0:
+                raise SignatureExpired(
+                    'Signature age %s > %s seconds' % (age, max_age))
+        try:
+            return self.serializer.loads(value[:-self.timestamp_size])
+        except Exception as exc:
+            raise BadPayload('Could not load the payload', exc)
+
+
+register_serializer('json')
+
+if orjson is not None:
+    register_serializer('orjson', OrjsonPayload())
+
+if msgpack is not None:
+    register_serializer(
+        'msgpack',
+        MsgpackPayload(),
+        content_type='application/x-msgpack',
+    )
+    register_serializer(
+        'binary',
+        MsgpackPayload(),
+        signer_class=BinaryTimedSerializer,
+        content_type='application/octet-stream',
+    )
@@ -0,0 +1,237 @@
+import hmac
+import uuid
+
+from itsdangerous import BadSignature, SignatureExpired
+try:
+    from itsdangerous.encoding import (
+        base64_decode,
+        base64_encode,
+        bytes_to_int,
+        want_bytes,
+    )
+except ImportError:  # pragma: no cover
+    # itsdangerous < 1.0
+    from itsdangerous import (
+        base64_decode,
+        base64_encode,
+        bytes_to_int,
+        want_bytes,
+    )
+
+from webservices.exceptions import WebserviceError
+
+
+CHUNK_SIZE = 64 * 1024
+# Signatures and timestamps are short base64 strings, anything longer
+# after a separator can only be part of the signed value.
+MAX_TRAILER_SIZE = 256
+STREAM_CONTENT_TYPE = 'application/x-ndjson'
+
+
+class StreamVerifier(object):
+    """
+    Verifies the signature of a value signed by an itsdangerous
+    ``TimedSerializer`` while it is being read, without holding the whole
+    value in memory.
+    """
+    def __init__(self, serializer, max_age=None):
+        self.signer = serializer.make_signer(serializer.salt)
+        self.max_age = max_age
+        self.sep = want_bytes(self.signer.sep)
+        self.mac = hmac.new(
+            self.signer.derive_key(),
+            digestmod=self.signer.algorithm.digest_method,
+        )
+        self.signed_length = 0
+        self.pending = b''
+        self.tail = b''
+
+    def update(self, chunk):
+        pending = self.pending + chunk
+        index = pending.rfind(self.sep)
+        if index == -1 or len(pending) - index > MAX_TRAILER_SIZE:
+            index = len(pending)
+        if index:
+            self._feed(pending[:index])
+        self.pending = pending[index:]
+
+    def _feed(self, data):
+        self.mac.update(data)
+        self.signed_length += len(data)
+        self.tail = (self.tail + data)[-MAX_TRAILER_SIZE:]
+
+    def verify(self):
+        """
+        Returns the length of the payload once the whole value has been
+        passed to ``update``. Raises ``BadSignature`` or
+        ``SignatureExpired`` like ``TimedSerializer.loads``.
+        """
+        if not self.pending.startswith(self.sep):
+            raise BadSignature('No "%s" found in value' % self.signer.sep)
+        signature = self.pending[len(self.sep):]
+        expected = base64_encode(self.mac.digest())
+        if not hmac.compare_digest(expected, signature):
+            raise BadSignature('Signature does not match')
+        if self.sep not in self.tail:
+            raise BadSignature('Timestamp missing')
+        encoded_timestamp = self.tail.rsplit(self.sep, 1)[1]
+        try:
+            timestamp = bytes_to_int(base64_decode(encoded_timestamp))
+        except Exception:
+            raise BadSignature('Malformed timestamp')
+        if self.max_age is not None:
+            age = self.signer.get_timestamp() - timestamp
+            if age > self.max_age or age < 0:
+                raise SignatureExpired(
+                    'Signature age %s > %s seconds' % (age, self.max_age))
+        return self.signed_length - len(encoded_timestamp) - len(self.sep)
+
+
+class PayloadReader(object):
+    """
+    Read only, file like view on the first ``length`` bytes of ``fileobj``.
+    Iterating over it yields chunks of at most ``chunk_size`` bytes, ``load``
+    reads and decodes the whole payload.
+    """
+    def __init__(self, fileobj, length, chunk_size=CHUNK_SIZE, loads=None):
+        fileobj.seek(0)
+        self.fileobj = fileobj
+        self.remaining = length
+        self.chunk_size = chunk_size
+        self.loads = loads
+
+    def load(self):
+        return self.loads(self.read())
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def verify_stream(serializer, fileobj, max_age=None, chunk_size=CHUNK_SIZE):
+    """
+    Verifies the signed value in the seekable ``fileobj`` chunk by chunk and
+    returns a ``PayloadReader`` on its (unsigned) payload.
+    """
+    verifier = StreamVerifier(serializer, max_age)
+    fileobj.seek(0)
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        verifier.update(chunk)
+    length = verifier.verify()
+    return PayloadReader(
+        fileobj, length, chunk_size, loads=serializer.load_payload)
+
+
+class ResponseStream(object):
+    """
+    Frames of a streamed response, returned by ``Provider.get_response`` in
+    place of the response body. Adapters send them as they are produced.
+    """
+    content_type = STREAM_CONTENT_TYPE
+
+    def __init__(self, frames):
+        self.frames = frames
+
+    def __iter__(self):
+        return self.frames
+
+    def close(self):
+        self.frames.close()
+
+
+class FrameWriter(object):
+    """
+    Signs the items of a streamed response one by one, each frame is a line
+    of ``signer.dumps`` output. Frames carry the id of the stream and a
+    sequence number so dropped, reordered or spliced frames are noticed,
+    the last frame marks the end of the stream or the error ending it.
+    """
+    def __init__(self, signer):
+        self.signer = signer
+        self.stream_id = uuid.uuid4().hex
+        self.sequence = 0
+
+    def dump(self, **frame):
+        frame['id'] = self.stream_id
+        frame['seq'] = self.sequence
+        self.sequence += 1
+        return want_bytes(self.signer.dumps(frame)) + b'\n'
+
+    def item(self, data):
+        return self.dump(data=data)
+
+    def end(self):
+        return self.dump(end=True)
+
+    def error(self, message, status_code=400):
+        return self.dump(error=message, status=status_code)
+
+
+class FrameReader(object):
+    """
+    Verifies the frames written by ``FrameWriter``. ``feed`` takes the
+    response body as it arrives and returns the items of the frames
+    completed by it, error frames are raised using ``error_for_status``.
+    """
+    def __init__(self, signer, max_age=None, error_for_status=None):
+        self.signer = signer
+        self.max_age = max_age
+        self.error_for_status = error_for_status
+        self.pending = b''
+        self.stream_id = None
+        self.sequence = 0
+        self.finished = False
+
+    def feed(self, data):
+        lines = (self.pending + data).split(b'\n')
+        self.pending = lines.pop()
+        items = []
+        for line in lines:
+            if not line:
+                continue
+            frame = self.load(line)
+            if 'data' in frame:
+                items.append(frame['data'])
+        return items
+
+    def load(self, line):
+        if self.finished:
+            raise WebserviceError('Data after the end of the stream')
+        frame = self.signer.loads(line, max_age=self.max_age)
+        if self.stream_id is None:
+            self.stream_id = frame.get('id')
+        if (frame.get('id') != self.stream_id or
+                frame.get('seq') != self.sequence):
+            raise WebserviceError('Frames out of sequence')
+        self.sequence += 1
+        if 'error' in frame:
+            self.finished = True
+            message = frame['error']
+            error = None
+            if self.error_for_status is not None:
+                error = self.error_for_status(
+                    frame.get('status', 400), message)
+            raise error or WebserviceError(message)
+        if frame.get('end'):
+            self.finished = True
+        return frame
+
+    def close(self):
+        """
+        Raises ``WebserviceError`` if the stream was cut short.
+        """
+        if self.pending.strip() or not self.finished:
+            raise WebserviceError('Incomplete stream')
@@ -1,29 +1,428 @@
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+from webservices.exceptions import DeadlineExceeded, RequestRejected
+from webservices.models import (
+    DEADLINE_HEADER,
+    STREAM_HEADER,
+    UNIX_SCHEME,
+    UNSIGNED,
+    BaseConsumer,
+    Response,
+    _join_url,
+    unix_socket_path,
+)
+from webservices.streaming import ResponseStream
+
+
+RETRY_STATUSES = (502, 503, 504)
+
+
+def _lower_keys(headers):
+    return dict((key.lower(), value) for key, value in headers.items())
+
+
+class UnixSocketConnection(HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        self.socket_path = kwargs.pop('socket_path')
+        super(UnixSocketConnection, self).__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except (OSError, IOError) as exc:
+            sock.close()
+            raise NewConnectionError(
+                self, 'Failed to connect to %s: %s' % (self.socket_path, exc))
+        return sock
 
-from webservices.models import BaseConsumer
+
+class UnixSocketConnectionPool(HTTPConnectionPool):
+    ConnectionCls = UnixSocketConnection
+
+
+class UnixSocketAdapter(HTTPAdapter):
+    """
+    Sends requests to ``http+unix`` URLs over the unix socket named by their
+    (percent encoded) host.
+    """
+    def __init__(self, pool_maxsize=10):
+        self.pool_maxsize = pool_maxsize
+        self.socket_pools = {}
+        self.socket_pools_lock = threading.Lock()
+        super(UnixSocketAdapter, self).__init__(pool_maxsize=pool_maxsize)
+
+    def get_connection(self, url, proxies=None):
+        socket_path = unix_socket_path(url)
+        with self.socket_pools_lock:
+            pool = self.socket_pools.get(socket_path)
+            if pool is None:
+                pool = self.socket_pools[socket_path] = (
+                    UnixSocketConnectionPool(
+                        'localhost', maxsize=self.pool_maxsize,
+                        socket_path=socket_path))
+        return pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None,
+                                        cert=None):
+        return self.get_connection(request.url, proxies)
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def close(self):
+        super(UnixSocketAdapter, self).close()
+        with self.socket_pools_lock:
+            for pool in self.socket_pools.values():
+                pool.close()
+            self.socket_pools.clear()
 
 
 class SyncConsumer(BaseConsumer):
-    def __init__(self, base_url, public_key, private_key):
-        super(SyncConsumer, self).__init__(base_url, public_key, private_key)
+    def __init__(self, base_url, public_key, private_key, max_connections=10,
+                 timeout=None, retries=2, backoff=0.1, max_backoff=2,
+                 **kwargs):
+        super(SyncConsumer, self).__init__(
+            base_url, public_key, private_key, **kwargs)
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
         self.session = requests.session()
+        adapter = HTTPAdapter(
+            pool_connections=max_connections, pool_maxsize=max_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.mount(
+            UNIX_SCHEME + '://', UnixSocketAdapter(max_connections))
+        self._executor = None
+        self._hedging_executor = None
+        self._executor_lock = threading.Lock()
+        self._calls = threading.local()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.max_connections)
+        return self._executor
+
+    @property
+    def hedging_executor(self):
+        if self._hedging_executor is None:
+            with self._executor_lock:
+                if self._hedging_executor is None:
+                    self._hedging_executor = ThreadPoolExecutor(
+                        self.max_connections)
+        return self._hedging_executor
+
+    def consume(self, path, data, max_age=None, timeout=None,
+                idempotent=False):
+        """
+        ``timeout`` is the deadline (in seconds) for the whole call including
+        retries, which are only made if the call is ``idempotent``.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        calls = self._calls
+        calls.deadline = None if timeout is None else time.time() + timeout
+        calls.idempotent = idempotent
+        try:
+            return super(SyncConsumer, self).consume(path, data, max_age)
+        finally:
+            calls.deadline = None
+            calls.idempotent = False
+
+    def consume_parallel(self, path, items, max_age=None, timeout=None,
+                         idempotent=False):
+        """
+        Calls ``path`` once for each of ``items`` concurrently. Returns the
+        results in order, failed calls are returned as their exception.
+        """
+        futures = [
+            self.executor.submit(
+                self.consume, path, data, max_age, timeout, idempotent)
+            for data in items
+        ]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as exc:
+                results.append(exc)
+        return results
+
+    def consume_stream(self, path, data, max_age=None, timeout=None):
+        """
+        Yields the items streamed by the provider as they arrive, each of
+        them verified on its own. ``timeout`` is the deadline for the whole
+        stream.
+        """
+        if not path.startswith('/'):
+            raise ValueError("Paths must start with a slash")
+        if timeout is None:
+            timeout = self.timeout
+        extra_headers = {STREAM_HEADER: '1'}
+        if timeout is not None:
+            extra_headers[DEADLINE_HEADER] = '%.3f' % timeout
+        chunks = self.open_stream(
+            self.build_url(path),
+            self.signer.dumps(data),
+            self.build_headers(extra_headers),
+            timeout,
+        )
+        reader = self.get_frame_reader(max_age)
+        for chunk in chunks:
+            for item in reader.feed(chunk):
+                yield item
+        reader.close()
+
+    def open_stream(self, url, data, headers,
+                    timeout=None):  # pragma: no cover
+        """
+        Sends the request and returns an iterator over the response body.
+        """
+        response = self.session.post(
+            url, data=data, headers=headers, timeout=timeout, stream=True)
+        if response.status_code != 200:
+            self.raise_for_status(response.status_code, response.content)
+
+        def chunks():
+            try:
+                for chunk in response.iter_content(None):
+                    yield chunk
+            finally:
+                response.close()
+        return chunks()
+
+    def get_timeout(self):
+        deadline = getattr(self._calls, 'deadline', None)
+        if deadline is None:
+            return None
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded('Deadline exceeded')
+        return remaining
+
+    def get_remaining_time(self):
+        deadline = getattr(self._calls, 'deadline', None)
+        if deadline is None:
+            return self.timeout
+        return max(deadline - time.time(), 0)
+
+    def get_backoff(self, attempt):
+        # Exponential backoff with full jitter.
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def with_retries(self, send):
+        """
+        Calls ``send(timeout)``, which returns a ``(status_code, body,
+        headers)`` tuple, retrying idempotent calls on connection errors and
+        ``RETRY_STATUSES`` until ``retries`` or the deadline run out.
+        """
+        retries = self.retries if getattr(
+            self._calls, 'idempotent', False) else 0
+        attempt = 0
+        while True:
+            timeout = self.get_timeout()
+            try:
+                response = send(timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= retries:
+                    raise
+            else:
+                if response[0] not in RETRY_STATUSES or attempt >= retries:
+                    return response
+            delay = self.get_backoff(attempt)
+            remaining = self.get_timeout()
+            if remaining is not None and delay >= remaining:
+                raise DeadlineExceeded('Deadline exceeded')
+            time.sleep(delay)
+            attempt += 1
 
     def send_request(self, url, data, headers):  # pragma: no cover
-        response = self.session.post(url, data=data, headers=headers)
-        self.raise_for_status(response.status_code, response.content)
-        return response.content
+        headers = dict(headers)
+
+        def send(timeout):
+            if timeout is not None:
+                # Retries have less time left than the first attempt.
+                headers[DEADLINE_HEADER] = '%.3f' % timeout
+            response = self.session.post(
+                url, data=data, headers=headers, timeout=timeout)
+            return response.status_code, response.content, response.headers
+        status_code, content, response_headers = self.with_retries(send)
+        self.raise_for_status(status_code, content)
+        return Response(content, _lower_keys(response_headers))
+
+    def send_to(self, endpoint, path, data, headers):
+        balancer = self.balancer
+        started = time.time()
+        try:
+            response = self.send_request(
+                _join_url(endpoint.base_url, path), data, headers)
+        except Exception as exc:
+            balancer.finish(
+                endpoint, time.time() - started, balancer.is_healthy(exc))
+            raise
+        balancer.finish(endpoint, time.time() - started, True)
+        return response
+
+    def send_balanced(self, path, data, headers):
+        balancer = self.balancer
+        endpoint = balancer.pick()
+        calls = self._calls
+        idempotent = getattr(calls, 'idempotent', False)
+        # Hedging sends the request twice, like retries only do for
+        # idempotent calls.
+        delay = balancer.hedge_delay() if idempotent else None
+        if delay is None:
+            return self.send_to(endpoint, path, data, headers)
+        deadline = getattr(calls, 'deadline', None)
+
+        def send(endpoint):
+            calls.deadline = deadline
+            calls.idempotent = idempotent
+            return self.send_to(endpoint, path, data, headers)
+
+        futures = [self.hedging_executor.submit(send, endpoint)]
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            hedge = balancer.pick(exclude=[endpoint])
+            if hedge is not None:
+                futures.append(self.hedging_executor.submit(send, hedge))
+        error = None
+        for future in as_completed(futures):
+            try:
+                return future.result()
+            except Exception as exc:
+                error = exc
+        raise error
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._hedging_executor is not None:
+            self._hedging_executor.shutdown(wait=False)
+        self.session.close()
+
+
+class LocalConsumer(SyncConsumer):
+    """
+    Calls ``provider`` in process instead of over HTTP, with the same API
+    and errors as the other consumers. Requests are still signed and
+    verified by ``Provider.get_response`` unless ``trusted`` is set: ``data``
+    and the results are then passed as is (they are not copied) and no keys
+    are needed, see ``Provider.get_trusted_response``.
+    """
+    def __init__(self, provider, public_key=None, private_key=None,
+                 trusted=False, base_url=None, **kwargs):
+        if base_url is None:
+            # Cache keys include it.
+            base_url = 'local://%s/' % type(provider).__name__
+        if trusted and private_key is None:
+            private_key = ''
+        super(LocalConsumer, self).__init__(
+            base_url, public_key, private_key, **kwargs)
+        self.provider = provider
+        self.trusted = trusted
+        if trusted:
+            self.signer = UNSIGNED
+
+    def build_url(self, path):
+        return path
+
+    def call_provider(self, url, data, headers, set_header=None):
+        headers = _lower_keys(headers)
+
+        def get_header(key, default):
+            return headers.get(key.lower(), default)
+
+        if self.trusted:
+            return self.provider.get_trusted_response(
+                data, get_header, set_header, url)
+        return self.provider.get_response(
+            'POST', data, get_header, set_header, url)
+
+    def raise_for_status(self, status_code, message):
+        if status_code != 200 and not isinstance(message, bytes):
+            # Like the response bodies other consumers get.
+            message = message.encode('utf-8')
+        super(LocalConsumer, self).raise_for_status(status_code, message)
+
+    def send_request(self, url, data, headers):
+        response_headers = {}
+        status_code, body = self.call_provider(
+            url, data, headers, response_headers.__setitem__)
+        self.raise_for_status(status_code, body)
+        return Response(body, _lower_keys(response_headers))
+
+    def open_stream(self, url, data, headers, timeout=None):
+        status_code, stream = self.call_provider(url, data, headers)
+        if status_code != 200:
+            self.raise_for_status(status_code, stream)
+
+        def chunks():
+            try:
+                for chunk in stream:
+                    yield chunk
+            finally:
+                stream.close()
+        return chunks()
+
+    def consume_stream(self, path, data, max_age=None, timeout=None):
+        if not self.trusted:
+            return super(LocalConsumer, self).consume_stream(
+                path, data, max_age, timeout)
+        return self._consume_trusted_stream(path, data, timeout)
+
+    def _consume_trusted_stream(self, path, data, timeout=None):
+        if not path.startswith('/'):
+            raise ValueError("Paths must start with a slash")
+        if timeout is None:
+            timeout = self.timeout
+        extra_headers = {STREAM_HEADER: '1'}
+        if timeout is not None:
+            extra_headers[DEADLINE_HEADER] = '%.3f' % timeout
+        status_code, items = self.call_provider(
+            path, data, self.build_headers(extra_headers))
+        if status_code != 200:
+            self.raise_for_status(status_code, items)
+        try:
+            for item in items:
+                yield item
+        except RequestRejected as rejected:
+            self.raise_for_status(*rejected.response)
+        finally:
+            items.close()
 
 
 class DjangoTestingConsumer(SyncConsumer):
-    def __init__(self, test_client, base_url, public_key, private_key):
+    def __init__(self, test_client, base_url, public_key, private_key,
+                 **kwargs):
         self.test_client = test_client
         super(DjangoTestingConsumer, self).__init__(
-            base_url, public_key, private_key)
+            base_url, public_key, private_key, **kwargs)
 
     def build_url(self, path):
         return path
 
     def send_request(self, url, data, headers):
+        content_type = headers.pop('Content-Type', 'application/json')
         headers = {
             'HTTP_%s' % header.upper().replace('-', '_'): value
             for header, value in headers.items()
@@ -31,25 +430,57 @@ class DjangoTestingConsumer(SyncConsumer):
         response = self.test_client.post(
             url,
             data=data,
-            content_type='application/json',
+            content_type=content_type,
             **headers
         )
         self.raise_for_status(response.status_code, response.content)
-        return response.content
+        return Response(response.content, _lower_keys(dict(response.items())))
+
+    def open_stream(self, url, data, headers, timeout=None):
+        content_type = headers.pop('Content-Type', 'application/json')
+        headers = {
+            'HTTP_%s' % header.upper().replace('-', '_'): value
+            for header, value in headers.items()
+        }
+        response = self.test_client.post(
+            url,
+            data=data,
+            content_type=content_type,
+            **headers
+        )
+        if response.status_code != 200:
+            self.raise_for_status(response.status_code, response.content)
+        if response.streaming:
+            return response.streaming_content
+        return iter([response.content])
 
 
 class FlaskTestingConsumer(DjangoTestingConsumer):
     def send_request(self, url, data, headers):
         response = self.test_client.post(url, data=data, headers=headers)
         self.raise_for_status(response.status_code, response.data)
-        return response.data
+        return Response(response.data, _lower_keys(response.headers))
+
+    def open_stream(self, url, data, headers, timeout=None):
+        response = self.test_client.post(
+            url, data=data, headers=headers, buffered=False)
+        if response.status_code != 200:
+            self.raise_for_status(response.status_code, response.get_data())
+
+        def chunks():
+            try:
+                for chunk in response.iter_encoded():
+                    yield chunk
+            finally:
+                response.close()
+        return chunks()
 
 
 def provider_for_django(provider):
-    from django.http import HttpResponse
+    from django.http import HttpResponse, StreamingHttpResponse
     from django.views.decorators.csrf import csrf_exempt
 
-    def provider_view(request):
+    def provider_view(request, *args, **kwargs):
         def get_header(key, default):
             django_key = 'HTTP_%s' % key.upper().replace('-', '_')
             return request.META.get(django_key, default)
@@ -58,27 +489,43 @@ def provider_for_django(provider):
             signed_data = request.body
         else:
             signed_data = request.raw_post_data
+        headers = {}
         status_code, data = provider.get_response(
             method,
             signed_data,
             get_header,
+            headers.__setitem__,
+            request.path,
         )
-        return HttpResponse(data, status=status_code)
+        if isinstance(data, ResponseStream):
+            response = StreamingHttpResponse(
+                data, status=status_code, content_type=data.content_type)
+        else:
+            response = HttpResponse(data, status=status_code)
+        for key, value in headers.items():
+            response[key] = value
+        return response
     return csrf_exempt(provider_view)
 
 
 def provider_for_flask(app, url, provider):
     from flask import request
 
-    def provider_view():
+    def provider_view(**kwargs):
         def get_header(key, default):
             return request.headers.get(key, default)
         method = request.method
         signed_data = request.data
+        headers = {}
         status_code, data = provider.get_response(
             method,
             signed_data,
             get_header,
+            headers.__setitem__,
+            request.path,
         )
-        return data, status_code
+        if isinstance(data, ResponseStream):
+            return app.response_class(
+                data, status_code, headers, content_type=data.content_type)
+        return data, status_code, headers
     return app.route(url, methods=['POST'])(provider_view)
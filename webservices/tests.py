@@ -12,25 +12,99 @@ settings.configure(
 )
 
 # real import
+import json
+import os
+import pickle
+import shutil
+import socket
 import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
 from unittest import TestCase
 
+try:
+    from urllib.parse import quote
+except ImportError:  # pragma: no cover
+    # python 2
+    from urllib import quote
+
+import requests
 from django.test.testcases import TestCase as DjangoTestCase
+from itsdangerous import (
+    BadSignature,
+    SignatureExpired,
+    TimedSerializer,
+    TimestampSigner,
+)
 
-from twisted.internet import reactor
+from twisted.internet import defer, reactor, task, threads
 from twisted.trial.unittest import TestCase as TwistedTestCase
 from twisted.web.server import Site
 
-from webservices.async import provider_for_twisted, TwistedConsumer
-from webservices.exceptions import BadRequest, WebserviceError
-from webservices.models import Provider, BaseConsumer, _split_dsn
+from webservices.async import (
+    get_response as twisted_get_response,
+    listen_unix,
+    provider_for_twisted,
+    ProviderSite,
+    TwistedConsumer,
+)
+from webservices.balancing import Balancer
+from webservices.cache import FileCache, LRUCache, make_key
+from webservices.compression import CompressedPayload, available_codecs
+from webservices.deadline import remaining, reset_deadline, set_deadline
+from webservices.serializers import (
+    JSONPayload,
+    BinaryTimedSerializer,
+    available_serializers,
+    msgpack,
+)
+from webservices.loadtest import LatencyHistogram, run as run_load
+from webservices.metrics import NULL_INSTRUMENTATION, NULL_TIMER, Collector
+from webservices.router import ProviderRouter
+from webservices.singleflight import Group
+from webservices.streaming import FrameReader, FrameWriter, verify_stream
+from webservices.exceptions import (
+    BadRequest,
+    DeadlineExceeded,
+    WebserviceError,
+)
+from webservices.models import (
+    PUBLIC_KEY_HEADER,
+    CACHE_TTL_HEADER,
+    DEADLINE_HEADER,
+    SERIALIZER_HEADER,
+    STREAM_HEADER,
+    COMPRESSION_HEADER,
+    Provider,
+    BaseConsumer,
+    _split_dsn,
+    unix_socket_path,
+)
+from webservices.unix import make_unix_server
+from webservices.wsgi import provider_for_wsgi
 from webservices.sync import (
     provider_for_flask,
     FlaskTestingConsumer,
     provider_for_django,
     DjangoTestingConsumer,
+    LocalConsumer,
+    SyncConsumer,
 )
 
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from webservices.aio import (
+        AsyncioConsumer,
+        ASGITestingConsumer,
+        provider_for_asgi,
+        provider_for_django_async,
+    )
+except (ImportError, SyntaxError):  # pragma: no cover
+    asyncio = AsyncioConsumer = None
+
 
 urlpatterns = []
 
@@ -56,6 +130,135 @@ class GreetingProvider(Provider):
         return {'greeting': u'Hello %s!' % name}
 
 
+class CountingProvider(GreetingProvider):
+    def __init__(self):
+        super(CountingProvider, self).__init__()
+        self.lookups = 0
+
+    def get_private_key(self, key):
+        self.lookups += 1
+        return super(CountingProvider, self).get_private_key(key)
+
+
+class CallCountingProvider(GreetingProvider):
+    def __init__(self):
+        super(CallCountingProvider, self).__init__()
+        self.calls = 0
+
+    def provide(self, data):
+        self.calls += 1
+        return super(CallCountingProvider, self).provide(data)
+
+
+class BlockingProvider(CallCountingProvider):
+    def __init__(self):
+        super(BlockingProvider, self).__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def provide(self, data):
+        self.started.set()
+        self.release.wait(5)
+        return super(BlockingProvider, self).provide(data)
+
+
+class DeferredProvider(CallCountingProvider):
+    def provide(self, data):
+        self.thread = threading.current_thread()
+        parent = super(DeferredProvider, self)
+        return task.deferLater(reactor, 0, parent.provide, data)
+
+
+class ChainedProvider(GreetingProvider):
+    def __init__(self, consumer):
+        super(ChainedProvider, self).__init__()
+        self.consumer = consumer
+
+    def provide(self, data):
+        d = self.consumer.consume('/', data)
+        d.addCallback(lambda result: {'greeting': result['greeting'].upper()})
+        return d
+
+
+class PastSigner(TimestampSigner):
+    def get_timestamp(self):
+        return super(PastSigner, self).get_timestamp() - 120
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class OffsetSigner(object):
+    def __init__(self, salt):
+        serializer = TimedSerializer('privatekey')
+        self.signer = serializer.make_signer(salt)
+
+    def __getattr__(self, name):
+        return getattr(self.signer, name)
+
+    def get_timestamp(self):
+        return self.signer.get_timestamp() + 60
+
+
+class GreetingRouter(ProviderRouter):
+    keys = GreetingProvider.keys
+
+    def __init__(self, providers, prefix='/'):
+        super(GreetingRouter, self).__init__(providers, prefix)
+        self.lookups = 0
+
+    def get_private_key(self, key):
+        self.lookups += 1
+        return self.keys.get(key)
+
+
+class EchoProvider(GreetingProvider):
+    def provide(self, data):
+        return data
+
+
+class BudgetProvider(CallCountingProvider):
+    def provide(self, data):
+        self.remaining = remaining()
+        return super(BudgetProvider, self).provide(data)
+
+
+class ExportProvider(GreetingProvider):
+    def provide(self, data):
+        if 'count' not in data:
+            return super(ExportProvider, self).provide(data)
+        return self.export(data)
+
+    def export(self, data):
+        for number in range(data['count']):
+            if number == data.get('fail_at'):
+                raise Exception('Error')
+            time.sleep(data.get('delay', 0))
+            yield {'n': number}
+
+
+class PidProvider(ExportProvider):
+    processes = 2
+
+    def init_worker(self):
+        self.initialized = os.getpid()
+
+    def provide(self, data):
+        if data.get('error') or 'count' in data:
+            return super(PidProvider, self).provide(data)
+        time.sleep(data.get('sleep', 0))
+        return {
+            'pid': os.getpid(),
+            'initialized': getattr(self, 'initialized', None),
+            'remaining': remaining(),
+        }
+
+
 class GetFlaskTestingConsumer(FlaskTestingConsumer):
     def send_request(self, url, data, headers):  # pragma: no cover
         response = self.test_client.get(url, data=data, headers=headers)
@@ -76,6 +279,574 @@ class BaseTests(TestCase):
         self.assertEqual(public_key, 'pub')
         self.assertEqual(private_key, 'priv')
 
+    def test_split_unix_dsn(self):
+        base_url, public_key, private_key = _split_dsn(
+            'http+unix://pub:priv@/run/Svc.sock/api/')
+        self.assertEqual(base_url, 'http+unix://%2Frun%2FSvc.sock/api/')
+        self.assertEqual(public_key, 'pub')
+        self.assertEqual(unix_socket_path(base_url), '/run/Svc.sock')
+        self.assertEqual(
+            _split_dsn('http+unix://pub:priv@/run/svc')[0],
+            'http+unix://%2Frun%2Fsvc/',
+        )
+        self.assertEqual(
+            _split_dsn('http+unix://pub:priv@%2Frun%2Fsvc/api/')[0],
+            'http+unix://%2Frun%2Fsvc/api/',
+        )
+        self.assertIsNone(unix_socket_path('http://localhost/'))
+
+    def test_join_unix_url(self):
+        consumer = BaseConsumer(
+            'http+unix://%2Frun%2Fsvc.sock/api/', 'pubkey', 'privatekey')
+        self.assertEqual(
+            consumer.build_url('/hello/'),
+            'http+unix://%2Frun%2Fsvc.sock/api/hello/',
+        )
+
+
+class SlowHostConsumer(FlaskTestingConsumer):
+    def __init__(self, *args, **kwargs):
+        super(SlowHostConsumer, self).__init__(*args, **kwargs)
+        self.sent = []
+
+    def send_request(self, url, data, headers):
+        self.sent.append(url)
+        if 'slow' in url:
+            time.sleep(0.5)
+        elif 'down' in url:
+            raise requests.ConnectionError()
+        return super(SlowHostConsumer, self).send_request(url, data, headers)
+
+
+class BalancerTests(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.balancer = Balancer(
+            ['http://a/', 'http://b/'],
+            failure_threshold=2,
+            reset_timeout=10,
+            clock=self.clock,
+        )
+        self.a, self.b = self.balancer.endpoints
+
+    def test_least_outstanding(self):
+        first = self.balancer.pick()
+        second = self.balancer.pick()
+        self.assertNotEqual(first, second)
+        self.balancer.finish(first, 0.1, True)
+        self.assertIs(self.balancer.pick(), first)
+
+    def test_circuit_breaker(self):
+        for _ in range(2):
+            self.b.outstanding += 1
+            self.balancer.finish(self.b, 0.1, False)
+        self.assertEqual(self.b.open_until, 10)
+        self.assertIs(self.balancer.pick(), self.a)
+        self.assertIs(self.balancer.pick(), self.a)
+        self.clock.now = 10
+        # A single request probes the host.
+        self.assertIs(self.balancer.pick(), self.b)
+        self.assertIs(self.balancer.pick(), self.a)
+        self.balancer.finish(self.b, 0.1, False)
+        self.assertEqual(self.b.open_until, 20)
+        self.clock.now = 20
+        self.assertIs(self.balancer.pick(), self.b)
+        self.balancer.finish(self.b, 0.1, True)
+        self.assertIsNone(self.b.open_until)
+
+    def test_no_healthy_endpoints(self):
+        self.a.open_until = self.b.open_until = 10
+        self.assertRaises(WebserviceError, self.balancer.pick)
+        self.assertIsNone(self.balancer.pick(exclude=[self.a]))
+
+    def test_is_healthy(self):
+        error = BadRequest('Bad Signature')
+        error.status_code = 400
+        self.assertTrue(self.balancer.is_healthy(error))
+        error = WebserviceError('Service unavailable')
+        error.status_code = 503
+        self.assertFalse(self.balancer.is_healthy(error))
+        self.assertFalse(self.balancer.is_healthy(requests.ConnectionError()))
+
+    def test_hedge_delay(self):
+        self.assertIsNone(self.balancer.hedge_delay())
+        self.balancer.hedge_percentile = 90
+        self.balancer.latencies.extend(i / 100.0 for i in range(100))
+        self.assertEqual(self.balancer.hedge_delay(), 0.9)
+
+    def test_from_dsn(self):
+        consumer = BaseConsumer.from_dsn('http://pub:priv@a:80,b:81/api/')
+        self.assertEqual(
+            [endpoint.base_url for endpoint in consumer.balancer.endpoints],
+            ['http://a:80/api/', 'http://b:81/api/'],
+        )
+        consumer = BaseConsumer.from_dsn('http://pub:priv@a/api/')
+        self.assertIsNone(consumer.balancer)
+
+    def get_consumer(self, *hosts, **kwargs):
+        from flask import Flask
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        provider_for_flask(app, '/', GreetingProvider())
+        return SlowHostConsumer(
+            app.test_client(), 'http://localhost', 'pubkey', 'privatekey',
+            balancer=Balancer(['http://%s/' % host for host in hosts],
+                              **kwargs))
+
+    def test_failover(self):
+        consumer = self.get_consumer('up', 'down', failure_threshold=1)
+        for _ in range(4):
+            try:
+                output = consumer.consume('/', {'name': 'Test'})
+            except requests.ConnectionError:
+                continue
+            self.assertEqual(output['greeting'], 'Hello Test!')
+        up, down = consumer.balancer.endpoints
+        self.assertIsNotNone(down.open_until)
+        self.assertEqual(up.outstanding, 0)
+        self.assertEqual(down.outstanding, 0)
+
+    def test_hedging(self):
+        consumer = self.get_consumer(
+            'slow', 'fast', hedge_percentile=50, hedge_min_samples=1)
+        consumer.balancer.latencies.append(0.01)
+        slow, fast = consumer.balancer.endpoints
+        fast.outstanding = 1
+        start = time.time()
+        output = consumer.consume('/', {'name': 'Test'}, idempotent=True)
+        self.assertEqual(output['greeting'], 'Hello Test!')
+        self.assertTrue(time.time() - start < 0.4)
+        consumer.close()
+
+    def test_no_hedging(self):
+        consumer = self.get_consumer(
+            'slow', 'fast', hedge_percentile=50, hedge_min_samples=1)
+        consumer.balancer.latencies.append(0.01)
+        slow, fast = consumer.balancer.endpoints
+        fast.outstanding = 1
+        output = consumer.consume('/', {'name': 'Test'})
+        self.assertEqual(output['greeting'], 'Hello Test!')
+        self.assertEqual(consumer.sent, ['http://slow/'])
+        consumer.close()
+
+
+class CacheTests(TestCase):
+    def test_lru_eviction(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats, {'hits': 3, 'misses': 1, 'size': 2})
+
+    def test_ttl(self):
+        clock = FakeClock()
+        cache = LRUCache(max_size=2, ttl=10, clock=clock)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=20)
+        clock.now = 15
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(len(cache), 1)
+
+    def test_make_key(self):
+        self.assertEqual(make_key('/', {'a': 1, 'b': 2}),
+                         make_key('/', {'b': 2, 'a': 1}))
+        self.assertNotEqual(make_key('/', {'a': 1}), make_key('/a', {'a': 1}))
+
+    def test_file_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        clock = FakeClock()
+        cache = FileCache(directory, max_size=2, clock=clock)
+        cache.set('a', b'1', ttl=10)
+        cache.set('b', b'2')
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(FileCache(directory).get('b'), b'2')
+        clock.now = 20
+        self.assertEqual(cache.get('a'), None)
+        cache.set('c', b'3')
+        cache.set('d', b'4')
+        self.assertEqual(len(cache), 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_file_cache_values(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = FileCache(directory)
+        cache.set('text', u'caf\xe9')
+        self.assertEqual(cache.get('text'), u'caf\xe9')
+        self.assertRaises(TypeError, cache.set, 'object', {'a': 1})
+        with open(os.path.join(directory, 'bad.cache'), 'wb') as fobj:
+            fobj.write(pickle.dumps((None, b'1')))
+        self.assertIsNone(cache.get('bad'))
+
+    def test_signer_cache(self):
+        provider = CountingProvider()
+        self.assertIsNotNone(provider.get_signer('pubkey'))
+        self.assertIs(provider.get_signer('pubkey'),
+                      provider.get_signer('pubkey'))
+        self.assertEqual(provider.lookups, 1)
+        self.assertEqual(provider.signer_cache.hits, 2)
+
+    def test_signer_cache_invalid_key(self):
+        provider = CountingProvider()
+        self.assertIsNone(provider.get_signer('unknown'))
+        self.assertIsNone(provider.get_signer('unknown'))
+        self.assertEqual(provider.lookups, 1)
+
+    def test_invalid_keys_do_not_evict(self):
+        provider = CountingProvider()
+        provider.signer_cache_size = 2
+        provider.invalid_key_cache_size = 2
+        provider.get_signer('pubkey')
+        for index in range(10):
+            self.assertIsNone(provider.get_signer('unknown%d' % index))
+        self.assertIsNotNone(provider.get_signer('pubkey'))
+        self.assertEqual(provider.lookups, 11)
+        self.assertEqual(len(provider.signer_cache), 1)
+        self.assertEqual(len(provider.invalid_key_cache), 2)
+
+    def test_signer_cache_invalidate(self):
+        provider = CountingProvider()
+        provider.get_signer('pubkey')
+        provider.invalidate_key('pubkey')
+        provider.get_signer('pubkey')
+        self.assertEqual(provider.lookups, 2)
+        provider.get_signer('unknown')
+        provider.invalidate_key()
+        self.assertEqual(len(provider.signer_cache), 0)
+        self.assertEqual(len(provider.invalid_key_cache), 0)
+
+
+class SerializerTests(TestCase):
+    def test_json_is_default(self):
+        self.assertIn('json', available_serializers())
+        consumer = BaseConsumer('http://localhost', 'pubkey', 'privatekey')
+        self.assertEqual(
+            TimedSerializer('privatekey').loads(consumer.signer.dumps(1)), 1)
+
+    def test_unsupported_serializer(self):
+        headers = {PUBLIC_KEY_HEADER: 'pubkey', SERIALIZER_HEADER: 'nope'}
+        status_code, data = GreetingProvider().get_response(
+            'POST', TimedSerializer('privatekey').dumps({}), headers.get)
+        self.assertEqual(status_code, 400)
+        self.assertEqual(data, "Unsupported serializer")
+
+    def test_signers_per_serializer(self):
+        provider = CountingProvider()
+        for serializer in available_serializers():
+            self.assertIsNotNone(provider.get_signer('pubkey', serializer))
+        self.assertEqual(provider.lookups, 1)
+
+    def test_binary(self):
+        if msgpack is None:  # pragma: no cover
+            self.skipTest('msgpack is not installed')
+        serializer = BinaryTimedSerializer('privatekey')
+        signed = serializer.dumps({'name': 'Test'})
+        self.assertEqual(serializer.loads(signed, max_age=10),
+                         {'name': 'Test'})
+        self.assertRaises(BadSignature,
+                          BinaryTimedSerializer('wrongkey').loads, signed)
+        self.assertRaises(BadSignature, serializer.loads, b'x' + signed)
+        self.assertRaises(BadSignature, serializer.loads, signed[:10])
+
+
+class CompressionTests(TestCase):
+    def test_threshold(self):
+        payload = CompressedPayload(JSONPayload(), 'zlib', threshold=100)
+        small = payload.dumps({'name': 'Test'})
+        large = payload.dumps({'name': 'Test' * 100})
+        self.assertTrue(small.startswith(b'0'))
+        self.assertTrue(large.startswith(b'z'))
+        self.assertTrue(len(large) < 100)
+        self.assertEqual(payload.loads(small), {'name': 'Test'})
+        self.assertEqual(payload.loads(large), {'name': 'Test' * 100})
+
+    def test_compressed_response(self):
+        consumer = BaseConsumer(
+            'http://localhost', 'pubkey', 'privatekey', compression='zlib')
+        headers = {PUBLIC_KEY_HEADER: 'pubkey', COMPRESSION_HEADER: 'zlib'}
+        provider = GreetingProvider()
+        provider.compression_threshold = 10
+        status_code, data = provider.get_response(
+            'POST', consumer.signer.dumps({'name': 'Test' * 100}),
+            headers.get)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(consumer.signer.loads(data)['greeting'],
+                         'Hello %s!' % ('Test' * 100))
+
+    def test_unsupported_compression(self):
+        headers = {PUBLIC_KEY_HEADER: 'pubkey', COMPRESSION_HEADER: 'nope'}
+        status_code, data = GreetingProvider().get_response(
+            'POST', TimedSerializer('privatekey').dumps({}), headers.get)
+        self.assertEqual(status_code, 400)
+        self.assertEqual(data, "Unsupported compression")
+
+
+class IdempotencyTests(TestCase):
+    headers = {PUBLIC_KEY_HEADER: 'pubkey'}
+
+    def _response(self, provider, signed_data):
+        response_headers = {}
+        status_code, data = provider.get_response(
+            'POST', signed_data, self.headers.get,
+            response_headers.__setitem__)
+        return status_code, data, response_headers
+
+    def test_duplicates(self):
+        provider = CallCountingProvider()
+        provider.idempotency_window = 60
+        provider.cache_ttl = 10
+        signed_data = TimedSerializer('privatekey').dumps({'name': 'Test'})
+        first = self._response(provider, signed_data)
+        second = self._response(provider, signed_data)
+        self.assertEqual(first, second)
+        self.assertEqual(second[2], {'x-services-cache-ttl': '10'})
+        self.assertEqual(provider.calls, 1)
+        self._response(
+            provider, TimedSerializer('privatekey').dumps({'name': 'Other'}))
+        self.assertEqual(provider.calls, 2)
+
+    def test_disabled_by_default(self):
+        provider = CallCountingProvider()
+        signed_data = TimedSerializer('privatekey').dumps({'name': 'Test'})
+        self._response(provider, signed_data)
+        self._response(provider, signed_data)
+        self.assertEqual(provider.calls, 2)
+
+    def test_errors_are_not_cached(self):
+        provider = CallCountingProvider()
+        provider.idempotency_window = 60
+        signed_data = TimedSerializer('privatekey').dumps({'error': True})
+        self.assertEqual(self._response(provider, signed_data)[0], 400)
+        self.assertEqual(self._response(provider, signed_data)[0], 400)
+        self.assertEqual(provider.calls, 2)
+
+    def test_max_bytes(self):
+        provider = CallCountingProvider()
+        provider.idempotency_window = 60
+        provider.idempotency_max_bytes = 10
+        signed_data = TimedSerializer('privatekey').dumps({'name': 'Test'})
+        self._response(provider, signed_data)
+        self._response(provider, signed_data)
+        self.assertEqual(provider.calls, 2)
+
+    def test_in_flight(self):
+        provider = BlockingProvider()
+        provider.idempotency_window = 60
+        signed_data = TimedSerializer('privatekey').dumps({'name': 'Test'})
+        results = []
+
+        def request():
+            results.append(self._response(provider, signed_data))
+
+        threads = [threading.Thread(target=request) for _ in range(3)]
+        threads[0].start()
+        provider.started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while provider.idempotency_calls.shared < 2:
+            time.sleep(0.001)
+        provider.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(provider.calls, 1)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+
+    def test_group_exception(self):
+        group = Group()
+
+        def fail():
+            raise ValueError()
+        self.assertRaises(ValueError, group.do, 'key', fail)
+        self.assertEqual(group.do('key', lambda: 1), 1)
+
+
+class CoalescingTests(TestCase):
+    def setUp(self):
+        from flask import Flask
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        self.provider = BlockingProvider()
+        provider_for_flask(app, '/', self.provider)
+        self.consumer = FlaskTestingConsumer(
+            app.test_client(), 'http://localhost', 'pubkey', 'privatekey',
+            coalesce=True)
+
+    def test_in_flight(self):
+        results = []
+
+        def consume(data):
+            results.append(self.consumer.consume('/', data))
+
+        threads = [
+            threading.Thread(target=consume, args=({'name': 'Test'},))
+            for _ in range(3)
+        ]
+        threads[0].start()
+        self.provider.started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while self.consumer.calls.shared < 2:
+            time.sleep(0.001)
+        self.provider.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.provider.calls, 1)
+        self.assertEqual(results, [{'greeting': 'Hello Test!'}] * 3)
+        self.consumer.consume('/', {'name': 'Test'})
+        self.assertEqual(self.provider.calls, 2)
+
+    def test_different_data(self):
+        self.provider.release.set()
+        self.consumer.consume('/', {'name': 'Test'})
+        self.consumer.consume('/', {'name': 'Other'})
+        self.assertEqual(self.provider.calls, 2)
+        self.assertEqual(self.consumer.calls.shared, 0)
+
+    def test_errors_are_shared(self):
+        self.provider.release.set()
+        self.assertRaises(
+            BadRequest, self.consumer.consume, '/', {'error': True})
+        self.assertEqual(self.provider.calls, 1)
+
+    def test_disabled_by_default(self):
+        consumer = SyncConsumer('http://localhost', 'pubkey', 'privatekey')
+        self.assertIsNone(consumer.calls)
+
+
+class StreamingTests(TestCase):
+    def _signed(self, data, key='privatekey'):
+        return BytesIO(TimedSerializer(key).dumps(data).encode('utf-8'))
+
+    def test_verify_stream(self):
+        data = {'name': 'Te.st' * 100, 'list': [1.5, 2.5]}
+        signed = self._signed(data)
+        for chunk_size in (1, 7, 1024):
+            payload = verify_stream(
+                TimedSerializer('privatekey'), signed, chunk_size=chunk_size)
+            self.assertEqual(json.loads(payload.read().decode('utf-8')), data)
+
+    def test_verify_stream_iter(self):
+        signed = self._signed({'name': 'Test'})
+        payload = verify_stream(
+            TimedSerializer('privatekey'), signed, chunk_size=4)
+        chunks = list(payload)
+        self.assertTrue(all(len(chunk) <= 4 for chunk in chunks))
+        self.assertEqual(json.loads(b''.join(chunks).decode('utf-8')),
+                         {'name': 'Test'})
+
+    def test_verify_stream_bad_signature(self):
+        signed = self._signed({'name': 'Test'}, key='wrongkey')
+        self.assertRaises(
+            BadSignature, verify_stream, TimedSerializer('privatekey'), signed)
+        tampered = BytesIO(self._signed({'a': 1}).getvalue().replace(
+            b'1', b'2', 1))
+        self.assertRaises(
+            BadSignature, verify_stream, TimedSerializer('privatekey'),
+            tampered)
+        self.assertRaises(
+            BadSignature, verify_stream, TimedSerializer('privatekey'),
+            BytesIO(b'{}'))
+
+    def test_verify_stream_expired(self):
+        serializer = TimedSerializer('privatekey')
+        signed = self._signed({'name': 'Test'})
+        serializer.make_signer = lambda salt: OffsetSigner(salt)
+        self.assertRaises(
+            SignatureExpired, verify_stream, serializer, signed, max_age=10)
+
+    def test_get_stream_response(self):
+        provider = GreetingProvider()
+        status_code, data = provider.get_stream_response(
+            'POST',
+            self._signed({'name': 'Test'}),
+            {PUBLIC_KEY_HEADER: 'pubkey'}.get,
+        )
+        self.assertEqual(status_code, 200)
+        self.assertEqual(TimedSerializer('privatekey').loads(data),
+                         {'greeting': 'Hello Test!'})
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        from flask import Flask
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        self.provider = CallCountingProvider()
+        provider_for_flask(app, '/', self.provider)
+        self.client = app.test_client()
+
+    def _consumer(self, **kwargs):
+        return FlaskTestingConsumer(
+            self.client, 'http://localhost', 'pubkey', 'privatekey', **kwargs)
+
+    def test_cache(self):
+        consumer = self._consumer(cache=LRUCache())
+        for _ in range(3):
+            output = consumer.consume('/', {'name': 'Test'})
+            self.assertEqual(output['greeting'], 'Hello Test!')
+        consumer.consume('/', {'name': 'Other'})
+        self.assertEqual(self.provider.calls, 2)
+        self.assertEqual(consumer.cache.stats['hits'], 2)
+
+    def test_file_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for _ in range(2):
+            consumer = self._consumer(cache=FileCache(directory))
+            output = consumer.consume('/', {'name': 'Test'})
+            self.assertEqual(output['greeting'], 'Hello Test!')
+        self.assertEqual(self.provider.calls, 1)
+
+    def test_expired_entry(self):
+        consumer = self._consumer(cache=LRUCache())
+        key = make_key(consumer.base_url, 'pubkey', consumer.serializer,
+                       consumer.compression, '/', {'name': 'Test'})
+        consumer.cache.set(key, TimedSerializer(
+            'privatekey', signer=PastSigner).dumps({'greeting': 'Stale'}))
+        output = consumer.consume('/', {'name': 'Test'}, max_age=60)
+        self.assertEqual(output['greeting'], 'Hello Test!')
+        consumer.consume('/', {'name': 'Test'}, max_age=60)
+        self.assertEqual(self.provider.calls, 1)
+        output = consumer.consume('/', {'name': 'Test'})
+        self.assertEqual(output['greeting'], 'Hello Test!')
+
+    def test_serializer_in_key(self):
+        cache = LRUCache()
+        self._consumer(cache=cache).consume('/', {'name': 'Test'})
+        consumer = self._consumer(cache=cache, compression='zlib')
+        output = consumer.consume('/', {'name': 'Test'})
+        self.assertEqual(output['greeting'], 'Hello Test!')
+        self.assertEqual(self.provider.calls, 2)
+
+    def test_path_ttl(self):
+        consumer = self._consumer(cache=LRUCache(), cache_ttls={'/': 0})
+        consumer.consume('/', {'name': 'Test'})
+        consumer.consume('/', {'name': 'Test'})
+        self.assertEqual(self.provider.calls, 2)
+
+    def test_provider_hint(self):
+        self.provider.cache_ttl = 0
+        consumer = self._consumer(cache=LRUCache())
+        consumer.consume('/', {'name': 'Test'})
+        consumer.consume('/', {'name': 'Test'})
+        self.assertEqual(self.provider.calls, 2)
+
+    def test_errors_are_not_cached(self):
+        consumer = self._consumer(cache=LRUCache())
+        self.assertRaises(BadRequest, consumer.consume, '/', {'error': True})
+        self.assertRaises(BadRequest, consumer.consume, '/', {'error': True})
+        self.assertEqual(self.provider.calls, 2)
+        self.assertEqual(len(consumer.cache), 0)
+
 
 class FlaskTests(TestCase):
     def setUp(self):
@@ -115,59 +886,1512 @@ class FlaskTests(TestCase):
         self.assertRaises(BadRequest, consumer.consume, '/', {'error': True})
         self.assertEqual(len(self.provider.exceptions), 1)
 
+    def test_consume_parallel(self):
+        consumer = FlaskTestingConsumer(
+            self.client, 'http://localhost', 'pubkey', 'privatekey')
+        output = consumer.consume_parallel(
+            '/', [{'name': 'Test'}, {'error': True}, {}])
+        consumer.close()
+        self.assertEqual(len(output), 3)
+        self.assertEqual(output[0]['greeting'], 'Hello Test!')
+        self.assertIsInstance(output[1], BadRequest)
+        self.assertEqual(output[2]['greeting'], 'Hello World!')
 
-class DjangoTests(DjangoTestCase):
-    def setUp(self):
-        from django.test.client import Client
-        self.client = Client()
+    def test_single_executor(self):
+        consumer = FlaskTestingConsumer(
+            self.client, 'http://localhost', 'pubkey', 'privatekey')
+        executors = []
+        threads = [
+            threading.Thread(
+                target=lambda: executors.append(consumer.executor))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        consumer.close()
+        self.assertEqual(len(set(map(id, executors))), 1)
 
-    @property
-    def urls(self):
-        from django.conf.urls import url, patterns
-        return patterns(
-            '',
-            url(r'^$', provider_for_django(GreetingProvider())),
-        )
+    def test_consume_many(self):
+        consumer = FlaskTestingConsumer(
+            self.client, 'http://localhost', 'pubkey', 'privatekey')
+        output = consumer.consume_many(
+            '/', [{'name': 'Test'}, {'error': True}, {}])
+        self.assertEqual(len(output), 3)
+        self.assertEqual(output[0]['greeting'], 'Hello Test!')
+        self.assertIsInstance(output[1], BadRequest)
+        self.assertEqual(output[2]['greeting'], 'Hello World!')
+        self.assertEqual(len(self.provider.exceptions), 1)
 
-    def test_greeting_provider(self):
-        consumer = DjangoTestingConsumer(
+    def test_serializers(self):
+        for serializer in available_serializers():
+            consumer = FlaskTestingConsumer(
+                self.client, 'http://localhost', 'pubkey', 'privatekey',
+                serializer=serializer)
+            output = consumer.consume('/', {'name': 'Test'})
+            self.assertEqual(output['greeting'], 'Hello Test!')
+            output = consumer.consume_many('/', [{'name': 'Test'}])
+            self.assertEqual(output[0]['greeting'], 'Hello Test!')
+
+    def test_compression(self):
+        for codec in available_codecs():
+            consumer = FlaskTestingConsumer(
+                self.client, 'http://localhost', 'pubkey', 'privatekey',
+                compression=codec, compression_threshold=10)
+            output = consumer.consume('/', {'name': 'Test' * 100})
+            self.assertEqual(output['greeting'], 'Hello %s!' % ('Test' * 100))
+
+    def test_consume_many_too_large(self):
+        self.provider.max_batch_size = 1
+        consumer = FlaskTestingConsumer(
             self.client, 'http://localhost', 'pubkey', 'privatekey')
+        self.assertRaises(BadRequest, consumer.consume_many, '/', [{}, {}])
+
+
+class WSGITests(TestCase):
+    def get_consumer(self, provider, private_key='privatekey', **kwargs):
+        from werkzeug.test import Client
+        client = Client(provider_for_wsgi(provider, **kwargs))
+        return FlaskTestingConsumer(
+            client, 'http://localhost', 'pubkey', private_key)
+
+    def test_greeting_provider(self):
+        consumer = self.get_consumer(GreetingProvider())
         output = consumer.consume('/', {'name': 'Test'})
         self.assertEqual(output['greeting'], 'Hello Test!')
 
     def test_greeting_provider_wrong_key(self):
-        consumer = DjangoTestingConsumer(
-            self.client, 'http://localhost', 'pubkey', 'wrongkey')
+        consumer = self.get_consumer(GreetingProvider(), 'wrongkey')
         self.assertRaises(BadRequest, consumer.consume, '/', {'name': 'Test'})
 
+    def test_method_not_allowed(self):
+        from werkzeug.test import Client
+        client = Client(provider_for_wsgi(GreetingProvider()))
+        response = client.get('/')
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(response.headers['Allow'], 'POST')
 
-class TwistedTests(TwistedTestCase):
+    def test_body_too_large(self):
+        consumer = self.get_consumer(GreetingProvider(), max_body_size=64)
+        self.assertRaises(
+            WebserviceError, consumer.consume, '/', {'name': 'x' * 128})
+
+    def test_headers(self):
+        provider = GreetingProvider()
+        provider.cache_ttl = 30
+        consumer = self.get_consumer(provider)
+        response = consumer.send_request('/', consumer.signer.dumps({}), {
+            PUBLIC_KEY_HEADER: 'pubkey',
+        })
+        self.assertEqual(response.headers[CACHE_TTL_HEADER], '30')
+        self.assertEqual(response.headers['content-type'], 'application/json')
+
+    def test_router(self):
+        router = GreetingRouter({'/greeting/': GreetingProvider()})
+        consumer = self.get_consumer(router)
+        output = consumer.consume('/greeting/', {'name': 'Test'})
+        self.assertEqual(output['greeting'], 'Hello Test!')
+        self.assertRaises(WebserviceError, consumer.consume, '/other/', {})
+
+
+class RouterTests(TestCase):
     def setUp(self):
-        resource = provider_for_twisted(GreetingProvider())
-        factory = Site(resource)
-        self.port = reactor.listenTCP(0, factory, interface="127.0.0.1")
-        self.client = None
+        from flask import Flask
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        self.greeting = CountingProvider()
+        self.router = GreetingRouter({
+            '/greeting/': self.greeting,
+            'echo': EchoProvider(),
+        }, prefix='/api/')
+        provider_for_flask(app, '/api/<path:path>', self.router)
+        self.consumer = FlaskTestingConsumer(
+            app.test_client(), 'http://localhost', 'pubkey', 'privatekey')
 
-    def tearDown(self):
-        if self.client is not None:
-            self.client.transport.loseConnection()
-        return self.port.stopListening()
+    def test_dispatch(self):
+        output = self.consumer.consume('/api/greeting/', {'name': 'Test'})
+        self.assertEqual(output['greeting'], 'Hello Test!')
+        output = self.consumer.consume('/api/echo', {'name': 'Test'})
+        self.assertEqual(output, {'name': 'Test'})
+        self.assertEqual(self.router.lookups, 1)
+        self.assertEqual(self.greeting.lookups, 0)
 
-    def _test(self, public_key, private_key, path, data):
-        base_url = 'http://127.0.0.1:%s/' % self.port.getHost().port
-        consumer = TwistedConsumer(base_url, public_key, private_key)
-        return consumer.consume(path, data)
+    def test_not_found(self):
+        self.assertRaises(
+            WebserviceError, self.consumer.consume, '/api/missing/', {})
+        self.assertEqual(self.router.lookups, 0)
 
-    def test_greeting_provider(self):
-        def cb(result):
-            self.assertEqual(result['greeting'], 'Hello Test!')
-        d = self._test('pubkey', 'privatekey', '/', {'name': 'Test'})
-        d.addCallback(cb)
-        return d
+    def test_errors(self):
+        self.assertRaises(
+            BadRequest, self.consumer.consume, '/api/greeting/', {
+                'error': True})
+        self.assertEqual(len(self.greeting.exceptions), 1)
 
-    def test_greeting_provider_wrong_key(self):
-        def cb(result):
-            self.assertRaises(BadRequest, result.raiseException)
-        d = self._test('pubkey', 'wrongkey', '/', {'name': 'Test'})
-        d.addErrback(cb)
-        return d
+    def test_consume_many(self):
+        output = self.consumer.consume_many(
+            '/api/greeting/', [{'name': 'Test'}, {'error': True}])
+        self.assertEqual(output[0]['greeting'], 'Hello Test!')
+        self.assertIsInstance(output[1], BadRequest)
+
+    def test_get_provider(self):
+        self.assertIs(self.router.get_provider('/api/echo/'),
+                      self.router.routes['echo'])
+        self.assertIsNone(self.router.get_provider('/apiecho/'))
+        self.assertIsNone(self.router.get_provider('/echo/'))
+        self.assertIsNone(self.router.get_provider(None))
+        provider = GreetingProvider()
+        self.assertIs(provider.get_provider(None), provider)
+
+    def test_idempotency_key(self):
+        self.router.idempotency_window = 60
+        self.consumer.consume('/api/greeting/', {'name': 'Test'})
+        output = self.consumer.consume('/api/echo/', {'name': 'Test'})
+        self.assertEqual(output, {'name': 'Test'})
+
+
+class LocalConsumerTests(TestCase):
+    def test_signed(self):
+        provider = GreetingProvider()
+        consumer = LocalConsumer(provider, 'pubkey', 'privatekey')
+        self.assertEqual(
+            consumer.consume('/', {'name': 'Test'}),
+            {'greeting': 'Hello Test!'},
+        )
+        with self.assertRaises(BadRequest) as context:
+            consumer.consume('/', {'error': True})
+        self.assertEqual(context.exception.status_code, 400)
+        self.assertEqual(
+            context.exception.args[0], b'Failed to process the request')
+        self.assertEqual(len(provider.exceptions), 1)
+        consumer = LocalConsumer(provider, 'pubkey', 'wrongkey')
+        self.assertRaises(BadRequest, consumer.consume, '/', {'name': 'Test'})
+
+    def test_trusted(self):
+        consumer = LocalConsumer(EchoProvider(), trusted=True)
+        data = {'items': [1, 2]}
+        self.assertIs(consumer.consume('/', data), data)
+        output = consumer.consume_many('/', [{'name': 'Test'}, 1, 2])
+        self.assertEqual(output[:2], [{'name': 'Test'}, 1])
+        consumer = LocalConsumer(GreetingProvider(), trusted=True)
+        self.assertRaises(BadRequest, consumer.consume, '/', {'error': True})
+        output = consumer.consume_many('/', [{'name': 'Test'}, {'error': 1}])
+        self.assertEqual(output[0], {'greeting': 'Hello Test!'})
+        self.assertIsInstance(output[1], BadRequest)
+
+    def test_router(self):
+        router = GreetingRouter({'/greeting/': GreetingProvider()})
+        for consumer in (LocalConsumer(router, 'pubkey', 'privatekey'),
+                         LocalConsumer(router, trusted=True)):
+            output = consumer.consume('/greeting/', {'name': 'Test'})
+            self.assertEqual(output['greeting'], 'Hello Test!')
+            with self.assertRaises(WebserviceError) as context:
+                consumer.consume('/missing/', {})
+            self.assertEqual(context.exception.status_code, 404)
+
+    def test_deadline(self):
+        provider = BudgetProvider()
+        for consumer in (LocalConsumer(provider, 'pubkey', 'privatekey'),
+                         LocalConsumer(provider, trusted=True)):
+            consumer.consume('/', {'name': 'Test'}, timeout=10)
+            self.assertTrue(0 < provider.remaining <= 10)
+            consumer.consume('/', {'name': 'Test'})
+            self.assertIsNone(provider.remaining)
+
+    def test_stream(self):
+        provider = ExportProvider()
+        for consumer in (LocalConsumer(provider, 'pubkey', 'privatekey'),
+                         LocalConsumer(provider, trusted=True)):
+            self.assertEqual(
+                list(consumer.consume_stream('/', {'count': 2})),
+                [{'n': 0}, {'n': 1}],
+            )
+            items = consumer.consume_stream('/', {'count': 3, 'fail_at': 1})
+            self.assertEqual(next(items), {'n': 0})
+            self.assertRaises(BadRequest, next, items)
+            items = consumer.consume_stream(
+                '/', {'count': 3, 'delay': 0.05}, timeout=0.07)
+            self.assertRaises(DeadlineExceeded, list, items)
+
+    def test_cache(self):
+        provider = CallCountingProvider()
+        provider.cache_ttl = 10
+        consumer = LocalConsumer(provider, trusted=True, cache=LRUCache())
+        consumer.consume('/', {'name': 'Test'})
+        output = consumer.consume('/', {'name': 'Test'})
+        self.assertEqual(output, {'greeting': 'Hello Test!'})
+        self.assertEqual(provider.calls, 1)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        from flask import Flask
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        self.provider = GreetingProvider()
+        self.provider.instrumentation = Collector()
+        provider_for_flask(app, '/', self.provider)
+        self.client = app.test_client()
+        self.collector = Collector()
+        self.consumer = FlaskTestingConsumer(
+            self.client, 'http://localhost', 'pubkey', 'privatekey',
+            instrumentation=self.collector)
+
+    def test_null_instrumentation(self):
+        self.assertIs(NULL_INSTRUMENTATION.timer('provider'), NULL_TIMER)
+        self.assertIs(GreetingProvider.instrumentation, NULL_INSTRUMENTATION)
+
+    def test_provider(self):
+        self.consumer.consume('/', {'name': 'Test'})
+        self.assertRaises(BadRequest, self.consumer.consume, '/', {
+            'error': True})
+        histograms = self.provider.instrumentation.histograms
+        self.assertEqual(sorted(histograms), [
+            ('provider', 'key'),
+            ('provider', 'provide'),
+            ('provider', 'sign'),
+            ('provider', 'verify'),
+        ])
+        self.assertEqual(histograms['provider', 'key'].count, 2)
+        self.assertEqual(histograms['provider', 'sign'].count, 1)
+        self.assertEqual(self.provider.instrumentation.counts, {
+            ('provider', 200, 'pubkey'): 1,
+            ('provider', 400, 'pubkey'): 1,
+        })
+
+    def test_unknown_keys(self):
+        for index in range(10):
+            consumer = FlaskTestingConsumer(
+                self.client, 'http://localhost', 'junk%d' % index,
+                'privatekey')
+            self.assertRaises(
+                BadRequest, consumer.consume, '/', {'name': 'Test'})
+        self.assertEqual(self.provider.instrumentation.counts, {
+            ('provider', 400, 'invalid'): 10,
+        })
+
+    def test_consumer(self):
+        self.consumer.consume('/', {'name': 'Test'})
+        wrong = FlaskTestingConsumer(
+            self.client, 'http://localhost', 'pubkey', 'wrongkey',
+            instrumentation=self.collector)
+        self.assertRaises(BadRequest, wrong.consume, '/', {'name': 'Test'})
+        self.assertEqual(sorted(self.collector.histograms), [
+            ('consumer', 'network'),
+            ('consumer', 'sign'),
+            ('consumer', 'verify'),
+        ])
+        self.assertEqual(self.collector.counts, {
+            ('consumer', 200, 'pubkey'): 1,
+            ('consumer', 400, 'pubkey'): 1,
+        })
+
+    def test_render(self):
+        collector = Collector(buckets=[0.1, 1])
+        collector.observe('provider', 'sign', 0.5)
+        collector.count('provider', 200, 'my"key')
+        self.assertEqual(collector.render(), '\n'.join([
+            '# HELP webservices_phase_seconds Time spent in each phase of '
+            'a request.',
+            '# TYPE webservices_phase_seconds histogram',
+            'webservices_phase_seconds_bucket'
+            '{le="0.1",phase="sign",side="provider"} 0',
+            'webservices_phase_seconds_bucket'
+            '{le="1",phase="sign",side="provider"} 1',
+            'webservices_phase_seconds_bucket'
+            '{le="+Inf",phase="sign",side="provider"} 1',
+            'webservices_phase_seconds_sum{phase="sign",side="provider"} 0.5',
+            'webservices_phase_seconds_count'
+            '{phase="sign",side="provider"} 1',
+            '# HELP webservices_requests_total Requests by status code and '
+            'public key.',
+            '# TYPE webservices_requests_total counter',
+            'webservices_requests_total'
+            '{public_key="my\\"key",side="provider",status="200"} 1',
+        ]) + '\n')
+
+
+class LoadTestTests(TestCase):
+    def test_histogram(self):
+        histogram = LatencyHistogram()
+        for value in range(1, 1001):
+            histogram.record(value / 1000.0)
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.percentile(50), 0.5, delta=0.005)
+        self.assertAlmostEqual(histogram.percentile(99), 0.99, delta=0.01)
+        self.assertEqual(histogram.percentile(100), 1.0)
+        self.assertAlmostEqual(histogram.mean, 0.5005)
+
+    def test_run(self):
+        from flask import Flask
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        provider_for_flask(app, '/', GreetingProvider())
+        consumer = FlaskTestingConsumer(
+            app.test_client(), 'http://localhost', 'pubkey', 'privatekey')
+        results = run_load(
+            consumer,
+            '/',
+            ['{"name": "$n"}', '{"error": true}'],
+            concurrency=2,
+            requests=10,
+        )
+        self.assertEqual(results.requests, 10)
+        self.assertEqual(results.errors, {'BadRequest': 5})
+        self.assertEqual(results.as_dict()['error_rate'], 0.5)
+        self.assertEqual(results.latencies.count, 10)
+
+
+class RetryTests(TestCase):
+    def setUp(self):
+        self.consumer = SyncConsumer(
+            'http://localhost', 'pubkey', 'privatekey', backoff=0)
+        self.consumer._calls.idempotent = True
+        self.attempts = []
+
+    def send(self, *responses):
+        responses = list(responses)
+
+        def send(timeout):
+            self.attempts.append(timeout)
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response, b'', {}
+        return send
+
+    def test_retry_status(self):
+        response = self.consumer.with_retries(self.send(503, 502, 200))
+        self.assertEqual(response[0], 200)
+        self.assertEqual(len(self.attempts), 3)
+
+    def test_retry_connection_error(self):
+        send = self.send(requests.ConnectionError(), 200)
+        self.assertEqual(self.consumer.with_retries(send)[0], 200)
+
+    def test_retries_exhausted(self):
+        response = self.consumer.with_retries(self.send(503, 503, 503))
+        self.assertEqual(response[0], 503)
+        self.assertEqual(len(self.attempts), 3)
+
+    def test_not_idempotent(self):
+        self.consumer._calls.idempotent = False
+        response = self.consumer.with_retries(self.send(503, 200))
+        self.assertEqual(response[0], 503)
+        self.assertRaises(
+            requests.ConnectionError,
+            self.consumer.with_retries,
+            self.send(requests.ConnectionError()),
+        )
+
+    def test_deadline(self):
+        self.consumer._calls.deadline = time.time() + 60
+        self.consumer.with_retries(self.send(200))
+        self.assertTrue(0 < self.attempts[0] <= 60)
+        self.consumer._calls.deadline = time.time() - 1
+        self.assertRaises(
+            DeadlineExceeded, self.consumer.with_retries, self.send(200))
+
+    def test_backoff(self):
+        consumer = SyncConsumer(
+            'http://localhost', 'pubkey', 'privatekey', backoff=1,
+            max_backoff=3)
+        for attempt in range(5):
+            self.assertTrue(0 <= consumer.get_backoff(attempt) <= 3)
+
+
+class DeadlineTests(TestCase):
+    def setUp(self):
+        from flask import Flask
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        self.provider = BudgetProvider()
+        provider_for_flask(app, '/', self.provider)
+        self.consumer = FlaskTestingConsumer(
+            app.test_client(), 'http://localhost', 'pubkey', 'privatekey')
+
+    def get_response(self, data, deadline):
+        headers = {PUBLIC_KEY_HEADER: 'pubkey', DEADLINE_HEADER: deadline}
+        return self.provider.get_response(
+            'POST', self.consumer.signer.dumps(data),
+            lambda key, default: headers.get(key, default))
+
+    def test_no_deadline(self):
+        output = self.consumer.consume('/', {'name': 'Test'})
+        self.assertEqual(output['greeting'], 'Hello Test!')
+        self.assertIsNone(self.provider.remaining)
+        self.assertIsNone(remaining())
+
+    def test_timeout_sent(self):
+        self.consumer.consume('/', {'name': 'Test'}, timeout=10)
+        self.assertTrue(0 < self.provider.remaining <= 10)
+        self.assertIsNone(remaining())
+
+    def test_expired(self):
+        status_code, _ = self.get_response({'name': 'Test'}, '0')
+        self.assertEqual(status_code, 504)
+        self.assertEqual(self.provider.calls, 0)
+        self.assertRaises(
+            DeadlineExceeded, self.consumer.request, '/', {'name': 'Test'},
+            extra_headers={DEADLINE_HEADER: '-1'})
+
+    def test_invalid_header(self):
+        status_code, _ = self.get_response({'name': 'Test'}, 'soon')
+        self.assertEqual(status_code, 200)
+        self.assertIsNone(self.provider.remaining)
+
+    def test_batch(self):
+        token = set_deadline(time.time() - 1)
+        try:
+            _, response_data = self.provider.get_batch_response(
+                self.consumer.signer, [{'name': 'Test'}])
+        finally:
+            reset_deadline(token)
+        results = self.consumer._unpack_batch(
+            self.consumer.signer.loads(response_data))
+        self.assertIsInstance(results[0], DeadlineExceeded)
+        self.assertEqual(self.provider.calls, 0)
+
+
+class ResponseStreamTests(TestCase):
+    def setUp(self):
+        from flask import Flask
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        self.provider = ExportProvider()
+        provider_for_flask(app, '/', self.provider)
+        self.client = app.test_client()
+        self.consumer = FlaskTestingConsumer(
+            self.client, 'http://localhost', 'pubkey', 'privatekey')
+
+    def test_consume_stream(self):
+        items = self.consumer.consume_stream('/', {'count': 3})
+        self.assertEqual(next(items), {'n': 0})
+        self.assertEqual(list(items), [{'n': 1}, {'n': 2}])
+        self.assertEqual(list(self.consumer.consume_stream('/', {
+            'count': 0})), [])
+
+    def test_consume(self):
+        output = self.consumer.consume('/', {'count': 2})
+        self.assertEqual(output, [{'n': 0}, {'n': 1}])
+        output = self.consumer.consume_many('/', [{'count': 1}])
+        self.assertEqual(output, [[{'n': 0}]])
+
+    def test_single_value(self):
+        output = list(self.consumer.consume_stream('/', {'name': 'Test'}))
+        self.assertEqual(output, [{'greeting': 'Hello Test!'}])
+
+    def test_error_before_first_item(self):
+        items = self.consumer.consume_stream('/', {'count': 3, 'fail_at': 0})
+        self.assertRaises(BadRequest, list, items)
+        self.assertEqual(len(self.provider.exceptions), 1)
+
+    def test_error_in_stream(self):
+        items = self.consumer.consume_stream('/', {'count': 3, 'fail_at': 2})
+        self.assertEqual(next(items), {'n': 0})
+        self.assertEqual(next(items), {'n': 1})
+        self.assertRaises(BadRequest, next, items)
+        self.assertEqual(len(self.provider.exceptions), 1)
+
+    def test_deadline(self):
+        items = self.consumer.consume_stream(
+            '/', {'count': 10, 'delay': 0.05}, timeout=0.12)
+        self.assertRaises(DeadlineExceeded, list, items)
+
+    def test_compression_rejected(self):
+        consumer = FlaskTestingConsumer(
+            self.client, 'http://localhost', 'pubkey', 'privatekey',
+            compression='zlib')
+        self.assertRaises(
+            BadRequest, list, consumer.consume_stream('/', {'count': 1}))
+
+    def test_streamed_request(self):
+        signer = self.consumer.signer
+        headers = {PUBLIC_KEY_HEADER: 'pubkey', STREAM_HEADER: '1'}
+        status_code, stream = self.provider.get_stream_response(
+            'POST', BytesIO(signer.dumps({'count': 2}).encode('utf-8')),
+            lambda key, default: headers.get(key, default))
+        self.assertEqual(status_code, 200)
+        reader = FrameReader(signer)
+        self.assertEqual(reader.feed(b''.join(stream)), [{'n': 0}, {'n': 1}])
+        reader.close()
+
+    def test_wsgi(self):
+        from werkzeug.test import Client
+        consumer = FlaskTestingConsumer(
+            Client(provider_for_wsgi(self.provider)), 'http://localhost',
+            'pubkey', 'privatekey')
+        output = list(consumer.consume_stream('/', {'count': 2}))
+        self.assertEqual(output, [{'n': 0}, {'n': 1}])
+
+    def test_frames_verified(self):
+        signer = self.consumer.signer
+        writer = FrameWriter(signer)
+        frames = [writer.item(1), writer.item(2), writer.end()]
+        reader = FrameReader(signer)
+        self.assertRaises(WebserviceError, reader.feed, frames[1])
+        reader = FrameReader(signer)
+        self.assertEqual(reader.feed(frames[0][:10]), [])
+        self.assertEqual(reader.feed(frames[0][10:] + frames[1]), [1, 2])
+        self.assertRaises(WebserviceError, reader.close)
+        other = FrameWriter(signer)
+        self.assertRaises(WebserviceError, reader.feed, other.end())
+        reader = FrameReader(signer)
+        self.assertRaises(
+            BadSignature, reader.feed, frames[0].replace(b'1', b'2'))
+
+
+class ProcessPoolTests(TestCase):
+    def setUp(self):
+        from flask import Flask
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        self.provider = PidProvider()
+        provider_for_flask(app, '/', self.provider)
+        self.consumer = FlaskTestingConsumer(
+            app.test_client(), 'http://localhost', 'pubkey', 'privatekey')
+
+    def tearDown(self):
+        if '_process_pool' in self.provider.__dict__:
+            self.provider.process_pool.close()
+
+    def test_worker_process(self):
+        output = self.consumer.consume('/', {})
+        self.assertNotEqual(output['pid'], os.getpid())
+        self.assertEqual(output['initialized'], output['pid'])
+        self.assertIsNone(output['remaining'])
+
+    def test_errors(self):
+        self.assertRaises(BadRequest, self.consumer.consume, '/', {
+            'error': True})
+        self.assertEqual(len(self.provider.exceptions), 1)
+
+    def test_consume_many(self):
+        output = self.consumer.consume_many('/', [{}, {'error': True}, {}])
+        self.assertNotEqual(output[0]['pid'], os.getpid())
+        self.assertIsInstance(output[1], BadRequest)
+        self.assertNotEqual(output[2]['pid'], os.getpid())
+
+    def test_recycling(self):
+        self.provider.processes = 1
+        self.provider.max_tasks_per_process = 1
+        first = self.consumer.consume('/', {})
+        second = self.consumer.consume('/', {})
+        self.assertNotEqual(first['pid'], second['pid'])
+
+    def test_deadline(self):
+        output = self.consumer.consume('/', {}, timeout=10)
+        self.assertTrue(0 < output['remaining'] <= 10)
+
+    def test_deadline_exceeded(self):
+        self.assertRaises(
+            DeadlineExceeded, self.consumer.consume, '/', {'sleep': 1},
+            timeout=0.3)
+        self.consumer.timeout = 0.3
+        output = self.consumer.consume_many('/', [{'sleep': 1}])
+        self.assertIsInstance(output[0], DeadlineExceeded)
+        self.assertEqual(self.provider.exceptions, [])
+
+    def test_stream_request(self):
+        signed = TimedSerializer('privatekey').dumps({}).encode('utf-8')
+        status_code, data = self.provider.get_stream_response(
+            'POST', BytesIO(signed), {PUBLIC_KEY_HEADER: 'pubkey'}.get)
+        self.assertEqual(status_code, 200)
+        output = TimedSerializer('privatekey').loads(data)
+        self.assertNotEqual(output['pid'], os.getpid())
+
+    def test_single_pool(self):
+        pools = []
+        threads = [
+            threading.Thread(
+                target=lambda: pools.append(self.provider.process_pool))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(map(id, pools))), 1)
+
+    def test_stream(self):
+        output = list(self.consumer.consume_stream('/', {'count': 2}))
+        self.assertEqual(output, [{'n': 0}, {'n': 1}])
+        output = self.consumer.consume('/', {'count': 2})
+        self.assertEqual(output, [{'n': 0}, {'n': 1}])
+
+    def test_pickle_metrics(self):
+        self.provider.instrumentation = Collector()
+        self.consumer.consume('/', {})
+        self.assertIn(
+            ('provider', 'pickle'), self.provider.instrumentation.histograms)
+
+    def test_local_state(self):
+        self.consumer.consume('/', {})
+        copy = pickle.loads(pickle.dumps(self.provider))
+        self.assertNotIn('_signer_cache', copy.__dict__)
+        self.assertNotIn('_process_pool', copy.__dict__)
+
+
+class DjangoTests(DjangoTestCase):
+    def setUp(self):
+        from django.test.client import Client
+        self.client = Client()
+
+    @property
+    def urls(self):
+        from django.conf.urls import url, patterns
+        return patterns(
+            '',
+            url(r'^$', provider_for_django(GreetingProvider())),
+        )
+
+    def test_greeting_provider(self):
+        consumer = DjangoTestingConsumer(
+            self.client, 'http://localhost', 'pubkey', 'privatekey')
+        output = consumer.consume('/', {'name': 'Test'})
+        self.assertEqual(output['greeting'], 'Hello Test!')
+
+    def test_greeting_provider_wrong_key(self):
+        consumer = DjangoTestingConsumer(
+            self.client, 'http://localhost', 'pubkey', 'wrongkey')
+        self.assertRaises(BadRequest, consumer.consume, '/', {'name': 'Test'})
+
+    def test_consume_many(self):
+        consumer = DjangoTestingConsumer(
+            self.client, 'http://localhost', 'pubkey', 'privatekey')
+        output = consumer.consume_many('/', [{'name': 'Test'}, {'error': 1}])
+        self.assertEqual(output[0]['greeting'], 'Hello Test!')
+        self.assertIsInstance(output[1], BadRequest)
+
+
+class TwistedTests(TwistedTestCase):
+    def get_resource(self):
+        return provider_for_twisted(GreetingProvider())
+
+    def setUp(self):
+        factory = ProviderSite(self.get_resource())
+        self.port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        self.consumers = []
+
+    def tearDown(self):
+        closed = [consumer.close() for consumer in self.consumers]
+        closed.append(self.port.stopListening())
+        d = defer.gatherResults(closed)
+        d.addCallback(lambda _: self.port.factory.resource.stop())
+        return d
+
+    def get_base_url(self):
+        return 'http://127.0.0.1:%s/' % self.port.getHost().port
+
+    def get_consumer(self, public_key='pubkey', private_key='privatekey',
+                     **kwargs):
+        base_url = self.get_base_url()
+        consumer = TwistedConsumer(base_url, public_key, private_key, **kwargs)
+        self.consumers.append(consumer)
+        return consumer
+
+    def _test(self, public_key, private_key, path, data):
+        consumer = self.get_consumer(public_key, private_key)
+        return consumer.consume(path, data)
+
+    def test_greeting_provider(self):
+        def cb(result):
+            self.assertEqual(result['greeting'], 'Hello Test!')
+        d = self._test('pubkey', 'privatekey', '/', {'name': 'Test'})
+        d.addCallback(cb)
+        return d
+
+    def test_greeting_provider_wrong_key(self):
+        def cb(result):
+            self.assertRaises(BadRequest, result.raiseException)
+        d = self._test('pubkey', 'wrongkey', '/', {'name': 'Test'})
+        d.addErrback(cb)
+        return d
+
+    def test_limit_held_while_reading(self):
+        consumer = self.get_consumer(max_connections=1)
+        limit = consumer.get_limit(self.get_base_url())
+        read_response = consumer.read_response
+        tokens = []
+
+        def read(response):
+            tokens.append(limit.tokens)
+            return read_response(response)
+        consumer.read_response = read
+
+        def cb(result):
+            self.assertEqual(result['greeting'], 'Hello Test!')
+            self.assertEqual(tokens, [0])
+            self.assertEqual(limit.tokens, 1)
+        d = consumer.consume('/', {'name': 'Test'})
+        d.addCallback(cb)
+        return d
+
+    def test_coalesce(self):
+        def cb(results):
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(results[0]['greeting'], 'Hello Test!')
+            self.assertEqual(consumer.calls.shared, 1)
+        consumer = self.get_consumer(coalesce=True)
+        d = defer.gatherResults([
+            consumer.consume('/', {'name': 'Test'}),
+            consumer.consume('/', {'name': 'Test'}),
+        ])
+        d.addCallback(cb)
+        return d
+
+    def test_coalesce_error(self):
+        def cb(result):
+            self.assertEqual(consumer.calls.shared, 1)
+            self.assertIsInstance(result.value.subFailure.value, BadRequest)
+        consumer = self.get_consumer(coalesce=True)
+        d = defer.gatherResults([
+            consumer.consume('/', {'error': True}),
+            consumer.consume('/', {'error': True}),
+        ], consumeErrors=True)
+        d.addErrback(cb)
+        return d
+
+    def test_consume_many(self):
+        def cb(result):
+            self.assertEqual(result[0]['greeting'], 'Hello Test!')
+            self.assertIsInstance(result[1], BadRequest)
+        consumer = self.get_consumer()
+        d = consumer.consume_many('/', [{'name': 'Test'}, {'error': True}])
+        d.addCallback(cb)
+        return d
+
+    def test_cache(self):
+        def cb(result):
+            self.assertEqual(result['greeting'], 'Hello Test!')
+            self.assertEqual(consumer.cache.stats['hits'], 1)
+        consumer = self.get_consumer(cache=LRUCache())
+        d = consumer.consume('/', {'name': 'Test'})
+        d.addCallback(lambda _: consumer.consume('/', {'name': 'Test'}))
+        d.addCallback(cb)
+        return d
+
+    def test_deadline_exceeded(self):
+        def cb(result):
+            self.assertRaises(DeadlineExceeded, result.raiseException)
+        consumer = self.get_consumer(timeout=10)
+        d = consumer.request(
+            '/', {'name': 'Test'}, extra_headers={DEADLINE_HEADER: '-1'})
+        d.addCallbacks(lambda _: self.fail('Deadline not enforced'), cb)
+        return d
+
+    def test_persistent_connections(self):
+        def cb(result):
+            self.assertEqual(len(result), 4)
+            self.assertTrue(consumer.pool._connections)
+        consumer = self.get_consumer(max_connections=2)
+        d = defer.gatherResults([
+            consumer.consume('/', {'name': 'Test %s' % i}) for i in range(4)
+        ])
+        d.addCallback(cb)
+        return d
+
+    def test_balancer(self):
+        def cb(result):
+            self.assertEqual(len(result), 4)
+            self.assertEqual(len(balancer.latencies), 4)
+            self.assertEqual(
+                [endpoint.outstanding for endpoint in balancer.endpoints],
+                [0, 0],
+            )
+        base_url = self.get_base_url()
+        balancer = Balancer([base_url, base_url])
+        consumer = self.get_consumer(balancer=balancer)
+        d = defer.gatherResults([
+            consumer.consume('/', {'name': 'Test %s' % i}) for i in range(4)
+        ])
+        d.addCallback(cb)
+        return d
+
+    def test_no_hedging(self):
+        def cb(result):
+            self.assertEqual(result['greeting'], 'Hello Test!')
+            self.assertEqual(len(sent), 1)
+        base_url = self.get_base_url()
+        balancer = Balancer(
+            [base_url, base_url], hedge_percentile=50, hedge_min_samples=1)
+        balancer.latencies.append(0)
+        consumer = self.get_consumer(balancer=balancer)
+        send_request = consumer.send_request
+        sent = []
+
+        def send(url, data, headers):
+            sent.append(url)
+            return send_request(url, data, headers)
+        consumer.send_request = send
+        d = consumer.consume('/', {'name': 'Test'})
+        d.addCallback(cb)
+        return d
+
+    def test_max_response_size(self):
+        def cb(result):
+            self.assertRaises(WebserviceError, result.raiseException)
+        consumer = self.get_consumer(max_response_size=10)
+        d = consumer.consume('/', {'name': 'Test'})
+        d.addErrback(cb)
+        return d
+
+
+class TwistedUnixTests(TwistedTests):
+    def setUp(self):
+        super(TwistedUnixTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.socket_path = os.path.join(self.directory, 'provider.sock')
+        self.unix_port = listen_unix(
+            self.port.factory.resource, self.socket_path)
+        self.addCleanup(self.unix_port.stopListening)
+
+    def get_base_url(self):
+        return 'http+unix://%s/' % quote(self.socket_path, safe='')
+
+    def test_from_dsn(self):
+        def cb(result):
+            self.assertEqual(result['greeting'], 'Hello Test!')
+        consumer = TwistedConsumer.from_dsn(
+            'http+unix://pubkey:privatekey@%s/' % self.socket_path)
+        self.consumers.append(consumer)
+        d = consumer.consume('/', {'name': 'Test'})
+        d.addCallback(cb)
+        return d
+
+
+class TwistedStreamingTests(TwistedTests):
+    def get_resource(self):
+        return provider_for_twisted(
+            GreetingProvider(), streaming=True, max_body_size=1024)
+
+    def test_body_too_large(self):
+        def cb(result):
+            self.assertRaises(WebserviceError, result.raiseException)
+        d = self._test('pubkey', 'privatekey', '/', {'name': 'x' * 2048})
+        d.addErrback(cb)
+        return d
+
+    def send_raw(self, data):
+        def send():
+            sock = socket.create_connection(
+                ('127.0.0.1', self.port.getHost().port), timeout=5)
+            try:
+                sock.sendall(data)
+                response = b''
+                while True:
+                    chunk = sock.recv(1024)
+                    if not chunk:
+                        return response
+                    response += chunk
+            finally:
+                sock.close()
+        return threads.deferToThread(send)
+
+    def test_body_rejected_on_length(self):
+        # The body is never sent, so only the content-length is checked.
+        d = self.send_raw(
+            b'POST / HTTP/1.1\r\nHost: localhost\r\n'
+            b'Content-Length: 4096\r\n\r\n')
+        d.addCallback(lambda response: self.assertTrue(
+            response.startswith(b'HTTP/1.1 413 ')))
+        return d
+
+    def test_chunked_body_rejected(self):
+        chunk = b'x' * 512
+        d = self.send_raw(
+            b'POST / HTTP/1.1\r\nHost: localhost\r\n'
+            b'Transfer-Encoding: chunked\r\n\r\n' +
+            (b'200\r\n' + chunk + b'\r\n') * 3)
+        d.addCallback(lambda response: self.assertTrue(
+            response.startswith(b'HTTP/1.1 413 ')))
+        return d
+
+
+class TwistedPoolTests(TwistedTests):
+    def get_resource(self):
+        return provider_for_twisted(
+            GreetingProvider(), pool_size=2, max_queue=4)
+
+    def test_stats(self):
+        resource = self.port.factory.resource
+
+        def cb(result):
+            stats = resource.stats.as_dict()
+            self.assertEqual(stats['completed'], 1)
+            self.assertEqual(stats['queued'], 0)
+            self.assertEqual(stats['running'], 0)
+        d = self._test('pubkey', 'privatekey', '/', {'name': 'Test'})
+        d.addCallback(cb)
+        return d
+
+    def test_load_shedding(self):
+        resource = self.port.factory.resource
+        resource.max_queue = 0
+
+        def cb(result):
+            self.assertRaises(WebserviceError, result.raiseException)
+            self.assertEqual(resource.stats.rejected, 1)
+        d = self._test('pubkey', 'privatekey', '/', {'name': 'Test'})
+        d.addErrback(cb)
+        return d
+
+
+class TwistedResponseStreamTests(TwistedTests):
+    def get_resource(self):
+        return provider_for_twisted(ExportProvider(), pool_size=2)
+
+    def test_consume_stream(self):
+        items = []
+        consumer = self.get_consumer()
+        d = consumer.consume_stream('/', {'count': 3}, items.append)
+        d.addCallback(lambda _: self.assertEqual(
+            items, [{'n': 0}, {'n': 1}, {'n': 2}]))
+        return d
+
+    def test_error_in_stream(self):
+        def cb(result):
+            self.assertRaises(BadRequest, result.raiseException)
+            self.assertEqual(items, [{'n': 0}])
+        items = []
+        consumer = self.get_consumer()
+        d = consumer.consume_stream(
+            '/', {'count': 3, 'fail_at': 1}, items.append)
+        d.addCallbacks(lambda _: self.fail('Error not raised'), cb)
+        return d
+
+
+class TwistedReactorTests(TwistedTests):
+    def get_resource(self):
+        return provider_for_twisted(DeferredProvider(), threaded=False)
+
+    def test_on_reactor(self):
+        provider = self.port.factory.resource.provider
+        d = self._test('pubkey', 'privatekey', '/', {'name': 'Test'})
+        d.addCallback(lambda _: self.assertIs(
+            provider.thread, threading.current_thread()))
+        return d
+
+    def test_chained(self):
+        port = reactor.listenTCP(
+            0, Site(provider_for_twisted(GreetingProvider())),
+            interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        consumer = TwistedConsumer(
+            'http://127.0.0.1:%s/' % port.getHost().port, 'pubkey',
+            'privatekey')
+        self.consumers.append(consumer)
+        self.port.factory.resource.provider = ChainedProvider(consumer)
+
+        def cb(result):
+            self.assertEqual(result['greeting'], 'HELLO TEST!')
+        d = self._test('pubkey', 'privatekey', '/', {'name': 'Test'})
+        d.addCallback(cb)
+        return d
+
+    def test_chained_error(self):
+        consumer = self.get_consumer(private_key='wrongkey')
+        provider = ChainedProvider(consumer)
+        provider.exceptions = []
+        self.port.factory.resource.provider = provider
+
+        def cb(result):
+            self.assertRaises(BadRequest, result.raiseException)
+            self.assertEqual(len(provider.exceptions), 1)
+            self.assertIs(provider.exceptions[0][0], BadRequest)
+        d = self._test('pubkey', 'privatekey', '/', {'name': 'Test'})
+        d.addCallbacks(lambda _: self.fail('Error not raised'), cb)
+        return d
+
+    def test_idempotency(self):
+        provider = DeferredProvider()
+        provider.idempotency_window = 60
+        signed_data = TimedSerializer('privatekey').dumps({'name': 'Test'})
+        headers = {PUBLIC_KEY_HEADER: 'pubkey'}
+
+        def cb(responses):
+            self.assertEqual(responses[0], responses[1])
+            self.assertEqual(responses[0][0], 200)
+            self.assertEqual(provider.calls, 1)
+        d = defer.gatherResults([
+            twisted_get_response(
+                provider, 'POST', signed_data,
+                lambda key, default: headers.get(key, default))
+            for _ in range(2)
+        ])
+        d.addCallback(cb)
+        return d
+
+    def test_processes_in_pool(self):
+        resource = self.port.factory.resource
+        resource.provider = PidProvider()
+        resource.pool_size = 1
+
+        def cb(result):
+            self.assertNotEqual(result['pid'], os.getpid())
+            self.assertEqual(resource.stats.completed, 1)
+            resource.provider.process_pool.close()
+        d = self._test('pubkey', 'privatekey', '/', {})
+        d.addCallback(cb)
+        return d
+
+    def test_streaming_requires_threads(self):
+        self.assertRaises(
+            ValueError, provider_for_twisted, DeferredProvider(),
+            streaming=True, threaded=False)
+
+
+class UnixSocketTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'provider.sock')
+        self.server = self.serve()
+        self.dsn = 'http+unix://pubkey:privatekey@%s/' % self.path
+
+    def tearDown(self):
+        self.stop()
+        shutil.rmtree(self.directory)
+
+    def serve(self):
+        server = make_unix_server(
+            provider_for_wsgi(GreetingProvider()), self.path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_sync_consumer(self):
+        consumer = SyncConsumer.from_dsn(self.dsn)
+        self.assertEqual(
+            consumer.consume('/', {'name': 'Test'}),
+            {'greeting': 'Hello Test!'},
+        )
+        self.assertRaises(
+            BadRequest, consumer.consume, '/', {'error': True})
+        consumer.close()
+
+    def test_asyncio_consumer(self):
+        if asyncio is None:  # pragma: no cover
+            self.skipTest('asyncio is not available')
+        consumer = AsyncioConsumer.from_dsn(self.dsn)
+
+        async def consume():
+            return await asyncio.gather(
+                consumer.consume('/', {'name': 'Test'}),
+                consumer.consume('/', {'name': 'Other'}),
+            )
+        loop = asyncio.new_event_loop()
+        try:
+            output = loop.run_until_complete(consume())
+            consumer.close()
+        finally:
+            loop.close()
+        self.assertEqual(output[1], {'greeting': 'Hello Other!'})
+
+    def test_connection_error(self):
+        consumer = SyncConsumer.from_dsn(
+            'http+unix://pubkey:privatekey@%s/' % os.path.join(
+                self.directory, 'missing.sock'),
+            retries=0)
+        self.assertRaises(
+            requests.ConnectionError, consumer.consume, '/', {})
+
+    def test_stale_socket(self):
+        self.stop()
+        self.assertTrue(os.path.exists(self.path))
+        self.server = self.serve()
+        consumer = SyncConsumer.from_dsn(self.dsn)
+        self.assertEqual(
+            consumer.consume('/', {'name': 'Test'}),
+            {'greeting': 'Hello Test!'},
+        )
+        consumer.close()
+        self.assertRaises(
+            socket.error, make_unix_server,
+            provider_for_wsgi(GreetingProvider()), self.path)
+
+
+class ProviderProtocol(object):
+    def __init__(self, provider, connections, respond=True):
+        self.provider = provider
+        self.respond = respond
+        self.buffer = b''
+        connections.append(self)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        head, sep, rest = self.buffer.partition(b'\r\n\r\n')
+        if not sep:
+            return
+        headers = {}
+        for line in head.decode('latin-1').split('\r\n')[1:]:
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if len(rest) < length or not self.respond:
+            return
+        self.buffer = rest[length:]
+        status_code, body = self.provider.get_response(
+            'POST',
+            rest[:length],
+            lambda key, default: headers.get(key.lower(), default),
+        )
+        body = body.encode('utf-8')
+        self.transport.write(
+            b'HTTP/1.1 %d OK\r\nContent-Length: %d\r\n\r\n' % (
+                status_code, len(body)) + body)
+
+    def eof_received(self):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+
+class AsyncioTests(TestCase):
+    def setUp(self):
+        if asyncio is None:  # pragma: no cover
+            self.skipTest('asyncio is not available')
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.connections = []
+        self.server = self._serve(respond=True)
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def _serve(self, respond):
+        return self.loop.run_until_complete(self.loop.create_server(
+            lambda: ProviderProtocol(
+                GreetingProvider(), self.connections, respond),
+            '127.0.0.1',
+            0,
+        ))
+
+    def _consumer(self, server=None, private_key='privatekey', **kwargs):
+        port = (server or self.server).sockets[0].getsockname()[1]
+        base_url = 'http://127.0.0.1:%s/' % port
+        return AsyncioConsumer(base_url, 'pubkey', private_key, **kwargs)
+
+    def test_greeting_provider(self):
+        consumer = self._consumer()
+        output = self.loop.run_until_complete(
+            consumer.consume('/', {'name': 'Test'}))
+        self.assertEqual(output['greeting'], 'Hello Test!')
+        consumer.close()
+
+    def test_greeting_provider_wrong_key(self):
+        consumer = self._consumer(private_key='wrongkey')
+        self.assertRaises(
+            BadRequest,
+            self.loop.run_until_complete,
+            consumer.consume('/', {'name': 'Test'}),
+        )
+        consumer.close()
+
+    def test_consume_many(self):
+        consumer = self._consumer()
+        output = self.loop.run_until_complete(
+            consumer.consume_many('/', [{'name': 'Test'}, {'error': True}]))
+        self.assertEqual(output[0]['greeting'], 'Hello Test!')
+        self.assertIsInstance(output[1], BadRequest)
+        consumer.close()
+
+    def test_connection_reuse(self):
+        consumer = self._consumer()
+        for name in ('One', 'Two', 'Three'):
+            output = self.loop.run_until_complete(
+                consumer.consume('/', {'name': name}))
+            self.assertEqual(output['greeting'], 'Hello %s!' % name)
+        self.assertEqual(len(self.connections), 1)
+        consumer.close()
+
+    def test_max_connections(self):
+        consumer = self._consumer(max_connections=2)
+        output = self.loop.run_until_complete(asyncio.gather(*[
+            consumer.consume('/', {'name': str(i)}) for i in range(6)
+        ]))
+        self.assertEqual(len(output), 6)
+        self.assertEqual(len(self.connections), 2)
+        consumer.close()
+
+    def test_timeout(self):
+        server = self._serve(respond=False)
+        consumer = self._consumer(server, timeout=0.1)
+        self.assertRaises(
+            asyncio.TimeoutError,
+            self.loop.run_until_complete,
+            consumer.consume('/', {'name': 'Test'}),
+        )
+        consumer.close()
+        server.close()
+        self.loop.run_until_complete(server.wait_closed())
+
+
+class AsyncGreetingProvider(GreetingProvider):
+    def provide(self, data):
+        response = super(AsyncGreetingProvider, self).provide(data)
+        return asyncio.sleep(0, result=response)
+
+
+class AsyncExportProvider(ExportProvider):
+    async def export(self, data):
+        for item in super(AsyncExportProvider, self).export(data):
+            await asyncio.sleep(0)
+            yield item
+
+
+class ThreadRecordingProvider(GreetingProvider):
+    def provide(self, data):
+        self.thread = threading.current_thread()
+        return super(ThreadRecordingProvider, self).provide(data)
+
+
+class ASGITests(TestCase):
+    def setUp(self):
+        if asyncio is None:  # pragma: no cover
+            self.skipTest('asyncio is not available')
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def _consume(self, provider, data, private_key='privatekey', **kwargs):
+        app = provider_for_asgi(provider, **kwargs)
+        consumer = ASGITestingConsumer(
+            app, 'http://localhost', 'pubkey', private_key)
+        if isinstance(data, list):
+            return self.loop.run_until_complete(
+                consumer.consume_many('/', data))
+        return self.loop.run_until_complete(consumer.consume('/', data))
+
+    def test_greeting_provider(self):
+        output = self._consume(GreetingProvider(), {'name': 'Test'})
+        self.assertEqual(output['greeting'], 'Hello Test!')
+
+    def test_greeting_provider_wrong_key(self):
+        self.assertRaises(
+            BadRequest,
+            self._consume, GreetingProvider(), {'name': 'Test'}, 'wrongkey',
+        )
+
+    def test_async_provider(self):
+        output = self._consume(AsyncGreetingProvider(), {'name': 'Test'})
+        self.assertEqual(output['greeting'], 'Hello Test!')
+
+    def test_async_provider_exception(self):
+        provider = AsyncGreetingProvider()
+        self.assertRaises(
+            BadRequest, self._consume, provider, {'error': True})
+        self.assertEqual(len(provider.exceptions), 1)
+
+    def test_consume_many(self):
+        output = self._consume(
+            AsyncGreetingProvider(), [{'name': 'Test'}, {'error': True}])
+        self.assertEqual(output[0]['greeting'], 'Hello Test!')
+        self.assertIsInstance(output[1], BadRequest)
+
+    def test_cache(self):
+        provider = CallCountingProvider()
+        consumer = ASGITestingConsumer(
+            provider_for_asgi(provider), 'http://localhost', 'pubkey',
+            'privatekey', cache=LRUCache())
+        for _ in range(2):
+            output = self.loop.run_until_complete(
+                consumer.consume('/', {'name': 'Test'}))
+            self.assertEqual(output['greeting'], 'Hello Test!')
+        self.assertEqual(provider.calls, 1)
+
+    def test_idempotency(self):
+        provider = CallCountingProvider()
+        provider.idempotency_window = 60
+        app = provider_for_asgi(provider)
+        consumer = ASGITestingConsumer(
+            app, 'http://localhost', 'pubkey', 'privatekey')
+        signed_data = consumer.signer.dumps({'name': 'Test'})
+        headers = {PUBLIC_KEY_HEADER: 'pubkey'}
+        responses = self.loop.run_until_complete(asyncio.gather(*[
+            consumer.send_request('/', signed_data, dict(headers))
+            for _ in range(3)
+        ]))
+        self.assertEqual(provider.calls, 1)
+        self.assertEqual(len(set(response.body for response in responses)), 1)
+
+    def test_executor(self):
+        provider = ThreadRecordingProvider()
+        executor = ThreadPoolExecutor(1)
+        output = self._consume(provider, {'name': 'Test'}, executor=executor)
+        executor.shutdown()
+        self.assertEqual(output['greeting'], 'Hello Test!')
+        self.assertIsNot(provider.thread, threading.current_thread())
+
+    def test_deadline(self):
+        provider = BudgetProvider()
+        executor = ThreadPoolExecutor(1)
+        consumer = ASGITestingConsumer(
+            provider_for_asgi(provider, executor), 'http://localhost',
+            'pubkey', 'privatekey', timeout=10)
+        self.loop.run_until_complete(consumer.consume('/', {'name': 'Test'}))
+        executor.shutdown()
+        self.assertTrue(0 < provider.remaining <= 10)
+
+    def test_coalesce(self):
+        provider = CallCountingProvider()
+        consumer = ASGITestingConsumer(
+            provider_for_asgi(provider), 'http://localhost', 'pubkey',
+            'privatekey', coalesce=True)
+        results = self.loop.run_until_complete(asyncio.gather(
+            consumer.consume('/', {'name': 'Test'}),
+            consumer.consume('/', {'name': 'Test'}),
+        ))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(provider.calls, 1)
+        self.assertEqual(consumer.calls.shared, 1)
+
+    def _consume_stream(self, provider, data, **kwargs):
+        consumer = ASGITestingConsumer(
+            provider_for_asgi(provider, **kwargs), 'http://localhost',
+            'pubkey', 'privatekey')
+
+        async def consume():
+            return [item async for item in consumer.consume_stream('/', data)]
+        return self.loop.run_until_complete(consume())
+
+    def test_consume_stream(self):
+        for provider in (ExportProvider(), AsyncExportProvider()):
+            output = self._consume_stream(provider, {'count': 2})
+            self.assertEqual(output, [{'n': 0}, {'n': 1}])
+        executor = ThreadPoolExecutor(1)
+        output = self._consume_stream(
+            ExportProvider(), {'count': 2}, executor=executor)
+        executor.shutdown()
+        self.assertEqual(output, [{'n': 0}, {'n': 1}])
+        output = self._consume(AsyncExportProvider(), {'count': 1})
+        self.assertEqual(output, [{'n': 0}])
+
+    def test_error_in_stream(self):
+        provider = AsyncExportProvider()
+        self.assertRaises(
+            BadRequest, self._consume_stream, provider,
+            {'count': 3, 'fail_at': 1})
+        self.assertEqual(len(provider.exceptions), 1)
+
+    def test_processes(self):
+        provider = PidProvider()
+        try:
+            output = self._consume(provider, [{}, {'error': True}])
+        finally:
+            provider.process_pool.close()
+        self.assertNotEqual(output[0]['pid'], os.getpid())
+        self.assertIsInstance(output[1], BadRequest)
+
+    def test_content_type(self):
+        provider = GreetingProvider()
+        for serializer, content_type in [
+                ('json', 'application/json'),
+                ('msgpack', 'application/x-msgpack'),
+                ('binary', 'application/octet-stream')]:
+            if serializer not in available_serializers():
+                continue
+            consumer = ASGITestingConsumer(
+                provider_for_asgi(provider), 'http://localhost', 'pubkey',
+                'privatekey', serializer=serializer)
+            status_code, headers, _ = self.loop.run_until_complete(
+                consumer.call_app('/', consumer.signer.dumps({}),
+                                  consumer.build_headers()))
+            self.assertEqual(status_code, 200)
+            self.assertEqual(headers['content-type'], content_type)
+        status_code, headers, _ = self.loop.run_until_complete(
+            consumer.call_app('/', b'garbage', consumer.build_headers()))
+        self.assertEqual(status_code, 400)
+        self.assertEqual(headers['content-type'], 'text/plain; charset=utf-8')
+
+    def _call_chunked(self, app, chunks):
+        messages = []
+        received = []
+
+        async def receive():
+            received.append(chunks[len(received)])
+            return {
+                'type': 'http.request',
+                'body': received[-1],
+                'more_body': len(received) < len(chunks),
+            }
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            'type': 'http',
+            'method': 'POST',
+            'path': '/',
+            'headers': [(b'x-services-public-key', b'pubkey')],
+        }
+        self.loop.run_until_complete(app(scope, receive, send))
+        return messages[0]['status'], len(received)
+
+    def test_body_too_large(self):
+        app = provider_for_asgi(GreetingProvider(), max_body_size=16)
+        status_code, received = self._call_chunked(app, [b'x' * 10] * 5)
+        self.assertEqual(status_code, 413)
+        self.assertEqual(received, 2)
+        consumer = ASGITestingConsumer(
+            app, 'http://localhost', 'pubkey', 'privatekey')
+        headers = consumer.build_headers()
+        headers['Content-Length'] = '1000'
+        status_code, _, messages = self.loop.run_until_complete(
+            consumer.call_app('/', b'x' * 1000, headers))
+        self.assertEqual(status_code, 413)
+        self.assertEqual(messages[0]['body'], b'Request body too large')
+
+
+class DjangoAsyncTests(TestCase):
+    def setUp(self):
+        if asyncio is None:  # pragma: no cover
+            self.skipTest('asyncio is not available')
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _post(self, provider, data, **headers):
+        from django.test.client import RequestFactory
+        request = RequestFactory().post(
+            '/', data=data, content_type='application/json',
+            HTTP_X_SERVICES_PUBLIC_KEY='pubkey', **headers)
+        view = provider_for_django_async(provider)
+        self.assertTrue(view.csrf_exempt)
+        return self.loop.run_until_complete(view(request))
+
+    def test_provider_view(self):
+        signed = TimedSerializer('privatekey').dumps({'name': 'Test'})
+        response = self._post(GreetingProvider(), signed)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            TimedSerializer('privatekey').loads(response.content),
+            {'greeting': 'Hello Test!'})
+
+    def test_wrong_key(self):
+        signed = TimedSerializer('wrongkey').dumps({'name': 'Test'})
+        response = self._post(GreetingProvider(), signed)
+        self.assertEqual(response.status_code, 400)
+
+    def test_stream(self):
+        signed = TimedSerializer('privatekey').dumps({'count': 2})
+        response = self._post(
+            AsyncExportProvider(), signed, HTTP_X_SERVICES_STREAM='1')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
@@ -0,0 +1,64 @@
+import errno
+import os
+import socket
+import stat
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    # python 2
+    from SocketServer import ThreadingMixIn
+
+
+class UnixWSGIRequestHandler(WSGIRequestHandler):
+    def __init__(self, request, client_address, server):
+        # Peers of unix sockets have no address.
+        WSGIRequestHandler.__init__(
+            self, request, ('localhost', 0), server)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixWSGIServer(ThreadingMixIn, WSGIServer):
+    address_family = socket.AF_UNIX
+    daemon_threads = True
+
+    def server_bind(self):
+        _remove_stale_socket(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
+        self.server_name = 'localhost'
+        self.server_port = 0
+        self.setup_environ()
+
+
+def _remove_stale_socket(path):
+    # Left over by a server which did not shut down cleanly, sockets still
+    # being listened on are kept so binding fails.
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except OSError:
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error as exc:
+        if exc.errno == errno.ECONNREFUSED:
+            os.remove(path)
+    finally:
+        probe.close()
+
+
+def make_unix_server(application, path, mode=0o666):
+    """
+    Returns a threaded ``wsgiref`` server for ``application`` (see
+    ``provider_for_wsgi``) listening on the unix socket ``path``, for
+    ``http+unix`` consumers on the same host. Call its ``serve_forever``.
+    """
+    server = UnixWSGIServer(path, UnixWSGIRequestHandler)
+    server.set_app(application)
+    os.chmod(path, mode)
+    return server
@@ -0,0 +1,93 @@
+from webservices.models import SERIALIZER_HEADER
+from webservices.serializers import (
+    DEFAULT_SERIALIZER,
+    SERIALIZERS,
+    get_content_type,
+)
+from webservices.streaming import ResponseStream
+
+
+DEFAULT_MAX_BODY_SIZE = 10 * 1024 * 1024
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Request Entity Too Large',
+    503: 'Service Unavailable',
+    504: 'Gateway Timeout',
+}
+
+
+def _read_body(environ, max_body_size):
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or -1)
+    except ValueError:
+        length = -1
+    stream = environ['wsgi.input']
+    if length < 0:
+        # Without a length, reading is only safe if the server marks the end
+        # of the body (chunked requests), otherwise the body is empty.
+        if not environ.get('wsgi.input_terminated'):
+            return 200, b''
+        if max_body_size is None:
+            return 200, stream.read()
+        body = stream.read(max_body_size + 1)
+        if len(body) > max_body_size:
+            return 413, b'Request body too large'
+        return 200, body
+    if max_body_size is not None and length > max_body_size:
+        return 413, b'Request body too large'
+    return 200, stream.read(length)
+
+
+def provider_for_wsgi(provider, max_body_size=DEFAULT_MAX_BODY_SIZE):
+    """
+    Returns a WSGI application serving ``provider``, without any framework.
+    Requests larger than ``max_body_size`` bytes are rejected with a ``413``.
+    """
+    def provider_app(environ, start_response):
+        def get_header(key, default):
+            return environ.get(
+                'HTTP_%s' % key.upper().replace('-', '_'), default)
+
+        status_code, data = _read_body(environ, max_body_size)
+        headers = {}
+        if status_code == 200:
+            status_code, data = provider.get_response(
+                environ['REQUEST_METHOD'],
+                data,
+                get_header,
+                headers.__setitem__,
+                environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+            )
+        if isinstance(data, ResponseStream):
+            # Sent as produced, the server closes it when the client is gone.
+            response_headers = [('Content-Type', data.content_type)]
+            response_headers.extend(
+                (key, str(value)) for key, value in headers.items())
+            start_response('200 OK', response_headers)
+            return data
+        if isinstance(data, list):
+            # The allowed methods of a 405 response.
+            data = headers['Allow'] = ', '.join(data)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        serializer = get_header(SERIALIZER_HEADER, DEFAULT_SERIALIZER)
+        if status_code == 200 and serializer in SERIALIZERS:
+            content_type = get_content_type(serializer)
+        else:
+            content_type = 'text/plain; charset=utf-8'
+        response_headers = [
+            ('Content-Type', content_type),
+            ('Content-Length', str(len(data))),
+        ]
+        response_headers.extend(
+            (key, str(value)) for key, value in headers.items())
+        start_response(
+            '%d %s' % (status_code, REASONS.get(status_code, 'Unknown')),
+            response_headers,
+        )
+        return [data]
+    return provider_app